@@ -17,6 +17,12 @@ import time
 import optparse
 from botocore.exceptions import ClientError
 
+from session_broker import SessionBroker
+
+# Assumed-role sessions shared by every client of an account, refreshed
+# before they expire during long teardowns
+broker = SessionBroker()
+
 
 def delete_stack(cfn_client, stack_name):
     try:
@@ -94,37 +100,11 @@ def delete_stack_set(cfn_client, org_client, stack_set_name, ou_name, region):
 
 
 def get_client(service, account_id, region='us-gov-west-1'):
-    sts_client = boto3.client('sts')
-
-    role_arn = f'arn:aws-us-gov:iam::{account_id}:role/CompliantFrameworkAccountAccessRole'
-    assumed_role = sts_client.assume_role(
-        RoleArn=role_arn,
-        RoleSessionName='CompliantFramework'
-    )
-    return boto3.client(
-        service,
-        aws_access_key_id=assumed_role['Credentials']['AccessKeyId'],
-        aws_secret_access_key=assumed_role['Credentials']['SecretAccessKey'],
-        aws_session_token=assumed_role['Credentials']['SessionToken'],
-        region_name=region
-    )
+    return broker.client(service, 'aws-us-gov', account_id, region=region)
 
 
 def get_resource(resource, account_id, region='us-gov-west-1'):
-    sts_client = boto3.client('sts')
-
-    role_arn = f'arn:aws-us-gov:iam::{account_id}:role/CompliantFrameworkAccountAccessRole'
-    assumed_role = sts_client.assume_role(
-        RoleArn=role_arn,
-        RoleSessionName='CompliantFramework'
-    )
-    return boto3.resource(
-        resource,
-        aws_access_key_id=assumed_role['Credentials']['AccessKeyId'],
-        aws_secret_access_key=assumed_role['Credentials']['SecretAccessKey'],
-        aws_session_token=assumed_role['Credentials']['SessionToken'],
-        region_name=region
-    )
+    return broker.resource(resource, 'aws-us-gov', account_id, region=region)
 
 
 def delete_objects(s3, bucket_name):
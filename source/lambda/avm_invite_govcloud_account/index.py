@@ -16,8 +16,15 @@ import sys
 import cfnresponse
 import boto3
 
+from boto3.session import Session
 
-def invite_govcloud_account(sts_client, org_client, account_id, region):
+from session_broker import SessionBroker
+
+# Session brokers of the GovCloud access keys, re-used by warm invocations
+brokers = {}
+
+
+def invite_govcloud_account(broker, org_client, account_id, region):
     response = org_client.list_accounts()
     print('list_accounts')
     print(response)
@@ -34,16 +41,8 @@ def invite_govcloud_account(sts_client, org_client, account_id, region):
     print('invite_account_to_organization')
     print(response)
     handshake_id = response['Handshake']['Id']
-    child_role = sts_client.assume_role(
-        RoleArn=f'arn:aws-us-gov:iam::{account_id}:role/CompliantFrameworkAccountAccessRole',
-        RoleSessionName='CreateGovCloudAccountRole'
-    )
-    child_org_client = boto3.client(
-        'organizations',
-        aws_access_key_id=child_role['Credentials']['AccessKeyId'],
-        aws_secret_access_key=child_role['Credentials']['SecretAccessKey'],
-        aws_session_token=child_role['Credentials']['SessionToken'],
-        region_name=region)
+    child_org_client = broker.client(
+        'organizations', 'aws-us-gov', account_id, region=region)
 
     response = child_org_client.accept_handshake(HandshakeId=handshake_id)
     print('accept_handshake')
@@ -71,11 +70,13 @@ def main(event, context):
                                  aws_access_key_id=govcloud_access_key_id,
                                  aws_secret_access_key=govcloud_secret_access_key,
                                  region_name=govcloud_region)
-    sts_client_gc = boto3.client('sts',
-                                 aws_access_key_id=govcloud_access_key_id,
-                                 aws_secret_access_key=govcloud_secret_access_key,
-                                 region_name=govcloud_region)
-    invite_govcloud_account(sts_client_gc, org_client_gc,
+    if govcloud_access_key_id not in brokers:
+        brokers[govcloud_access_key_id] = SessionBroker(
+            Session(aws_access_key_id=govcloud_access_key_id,
+                    aws_secret_access_key=govcloud_secret_access_key,
+                    region_name=govcloud_region),
+            role_session_name='CreateGovCloudAccountRole')
+    invite_govcloud_account(brokers[govcloud_access_key_id], org_client_gc,
                             govcloud_account_id, govcloud_region)
 
 
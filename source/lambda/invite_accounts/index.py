@@ -13,6 +13,10 @@
 
 import boto3
 
+from boto3.session import Session
+
+from session_broker import SessionBroker
+
 SSM_GOVCLOUD_ACCESS_KEY_ID = '/compliant/framework/central/aws-us-gov/access-key-id'
 SSM_GOVCLOUD_SECRET_ACCESS_KEY = '/compliant/framework/central/aws-us-gov/secret-access-key'
 
@@ -20,8 +24,11 @@ SSM_GOVCLOUD_LOGGING_ACCOUNT_ID = '/compliant/framework/accounts/core/logging/aw
 SSM_GOVCLOUD_TRANSIT_ACCOUNT_ID = '/compliant/framework/accounts/prod/transit/aws-us-gov/id'
 SSM_GOVCLOUD_MS_ACCOUNT_ID = '/compliant/framework/accounts/prod/management-services/aws-us-gov/id'
 
+# Session brokers of the GovCloud access keys, re-used by warm invocations
+brokers = {}
 
-def invite_govcloud_account(sts_client,
+
+def invite_govcloud_account(broker,
                             org_client,
                             account_id):
 
@@ -44,17 +51,8 @@ def invite_govcloud_account(sts_client,
 
     handshake_id = response['Handshake']['Id']
 
-    child_role = sts_client.assume_role(
-        RoleArn=f'arn:aws-us-gov:iam::{account_id}:role/CompliantFrameworkAccountAccessRole',
-        RoleSessionName='CompliantFrameworkInstall'
-    )
-
-    child_org_client = boto3.client(
-        'organizations',
-        aws_access_key_id=child_role['Credentials']['AccessKeyId'],
-        aws_secret_access_key=child_role['Credentials']['SecretAccessKey'],
-        aws_session_token=child_role['Credentials']['SessionToken'],
-        region_name='us-gov-west-1')
+    child_org_client = broker.client(
+        'organizations', 'aws-us-gov', account_id, region='us-gov-west-1')
 
     response = child_org_client.accept_handshake(HandshakeId=handshake_id)
     print('accept_handshake')
@@ -78,10 +76,13 @@ def lambda_handler(event, context):
                                  aws_secret_access_key=govcloud_secret_access_key,
                                  region_name=govcloud_region)
 
-    sts_client_gc = boto3.client('sts',
-                                 aws_access_key_id=govcloud_access_key_id,
-                                 aws_secret_access_key=govcloud_secret_access_key,
-                                 region_name=govcloud_region)
+    if govcloud_access_key_id not in brokers:
+        brokers[govcloud_access_key_id] = SessionBroker(
+            Session(aws_access_key_id=govcloud_access_key_id,
+                    aws_secret_access_key=govcloud_secret_access_key,
+                    region_name=govcloud_region),
+            role_session_name='CompliantFrameworkInstall')
+    broker = brokers[govcloud_access_key_id]
 
     #
     logging_account_id = ssm_client.get_parameter(
@@ -96,9 +97,9 @@ def lambda_handler(event, context):
         Name=SSM_GOVCLOUD_MS_ACCOUNT_ID
     )['Parameter']['Value']
 
-    invite_govcloud_account(sts_client_gc, org_client_gc, logging_account_id)
-    invite_govcloud_account(sts_client_gc, org_client_gc, transit_account_id)
-    invite_govcloud_account(sts_client_gc, org_client_gc,
+    invite_govcloud_account(broker, org_client_gc, logging_account_id)
+    invite_govcloud_account(broker, org_client_gc, transit_account_id)
+    invite_govcloud_account(broker, org_client_gc,
                             management_services_account_id)
 
     return {}
@@ -0,0 +1,95 @@
+######################################################################################################################
+#  Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.                                           #
+#                                                                                                                    #
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance    #
+#  with the License. A copy of the License is located at                                                             #
+#                                                                                                                    #
+#      http://www.apache.org/licenses/LICENSE-2.0                                                                    #
+#                                                                                                                    #
+#  or in the 'license' file accompanying this file. This file is distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES #
+#  OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions    #
+#  and limitations under the License.                                                                                #
+######################################################################################################################
+
+import threading
+
+from boto3.session import Session
+from botocore.credentials import RefreshableCredentials
+from botocore.session import get_session
+
+# Default role assumed in the accounts of the framework
+DEFAULT_ROLE_NAME = 'CompliantFrameworkAccountAccessRole'
+
+
+class SessionBroker:
+    """ Hands out clients for roles assumed in other accounts
+
+    Assumed-role sessions are cached by (partition, account, role, region)
+    for the life of the broker, i.e. across warm invocations when the broker
+    is created at module level. Their credentials are refreshed by botocore
+    shortly before they expire: within the advisory window a single thread
+    refreshes them while the others keep using the current credentials, so
+    callers only wait on STS when the credentials are about to expire.
+
+    Clients are cached as well and are thread-safe, sessions are only used
+    under the lock.
+    """
+
+    def __init__(self, session=None, role_session_name='CompliantFramework'):
+        # Session whose credentials assume the roles
+        self.session = session or Session()
+        self.role_session_name = role_session_name
+        self.sessions = {}
+        self.clients = {}
+        self.lock = threading.Lock()
+
+    def assume_role(self, sts_client, partition, account_id, role_name):
+        """Return fresh credentials metadata in the format botocore refreshes from."""
+        credentials = sts_client.assume_role(
+            RoleArn=f'arn:{partition}:iam::{account_id}:role/{role_name}',
+            RoleSessionName=self.role_session_name
+        )['Credentials']
+        return {
+            'access_key': credentials['AccessKeyId'],
+            'secret_key': credentials['SecretAccessKey'],
+            'token': credentials['SessionToken'],
+            'expiry_time': credentials['Expiration'].isoformat()
+        }
+
+    def get_session(self, partition, account_id, role_name=DEFAULT_ROLE_NAME, region=None):
+        key = (partition, account_id, role_name, region)
+        with self.lock:
+            if key not in self.sessions:
+                # Credentials may be refreshed from any thread, the STS
+                # client is created up front
+                sts_client = self.session.client('sts', region_name=region)
+
+                def refresh():
+                    return self.assume_role(
+                        sts_client, partition, account_id, role_name)
+
+                credentials = RefreshableCredentials.create_from_metadata(
+                    metadata=refresh(),
+                    refresh_using=refresh,
+                    method='sts-assume-role')
+
+                botocore_session = get_session()
+                botocore_session._credentials = credentials
+                self.sessions[key] = Session(
+                    botocore_session=botocore_session, region_name=region)
+            return self.sessions[key]
+
+    def client(self, service, partition, account_id, role_name=DEFAULT_ROLE_NAME, region=None):
+        key = (service, partition, account_id, role_name, region)
+        if key not in self.clients:
+            session = self.get_session(partition, account_id, role_name, region)
+            with self.lock:
+                if key not in self.clients:
+                    self.clients[key] = session.client(service)
+        return self.clients[key]
+
+    def resource(self, resource, partition, account_id, role_name=DEFAULT_ROLE_NAME, region=None):
+        """Resources are not thread-safe, a new one is returned on each call."""
+        session = self.get_session(partition, account_id, role_name, region)
+        with self.lock:
+            return session.resource(resource)
@@ -0,0 +1,163 @@
+######################################################################################################################
+#  Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.                                           #
+#                                                                                                                    #
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance    #
+#  with the License. A copy of the License is located at                                                             #
+#                                                                                                                    #
+#      http://www.apache.org/licenses/LICENSE-2.0                                                                    #
+#                                                                                                                    #
+#  or in the 'license' file accompanying this file. This file is distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES #
+#  OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions    #
+#  and limitations under the License.                                                                                #
+######################################################################################################################
+
+import boto3
+import json
+import os
+
+from output_registry import publish_outputs
+
+# Stack statuses ending a create_update_stack job
+STACK_SUCCEEDED = [
+    'CREATE_COMPLETE',
+    'UPDATE_COMPLETE'
+]
+STACK_FAILED = [
+    'UPDATE_ROLLBACK_COMPLETE',
+    'ROLLBACK_COMPLETE',
+    'CREATE_FAILED',
+    'ROLLBACK_FAILED',
+    'DELETE_FAILED',
+    'UPDATE_ROLLBACK_FAILED'
+]
+
+# Stack set operation statuses ending a stack_set_action job
+OPERATION_SUCCEEDED = ['SUCCEEDED']
+OPERATION_FAILED = ['FAILED', 'STOPPED']
+
+
+def get_job_params(cp_client, job_id):
+    """ UserParameters of a job waiting for the completion event
+
+    create_update_stack and stack_set_action start their operations with
+    the job id as the client request token or operation id. Returns None
+    for operations started by anything else, for jobs of other pipelines and
+    for jobs which poll for their completion.
+    """
+    try:
+        job = cp_client.get_job_details(jobId=job_id)['jobDetails']
+        pipeline_name = job['data']['pipelineContext']['pipelineName']
+        params = json.loads(
+            job['data']['actionConfiguration']['configuration']['UserParameters'])
+    except Exception as e:
+        print(f'{job_id} is not a pipeline job: {e}')
+        return None
+
+    if pipeline_name != os.environ['PIPELINE_NAME']:
+        print(f'{job_id} belongs to {pipeline_name}')
+        return None
+
+    if params.get('completionMode') != 'event':
+        print(f'{job_id} polls for its completion')
+        return None
+    return params
+
+
+def put_job_result(cp_client, job_id, failure_details=None, **kwargs):
+    """ Reports the result of a job, once
+
+    A job already completed, by a retried invocation for instance, is
+    ignored.
+    """
+    try:
+        if failure_details is None:
+            cp_client.put_job_success_result(jobId=job_id, **kwargs)
+        else:
+            cp_client.put_job_failure_result(
+                jobId=job_id, failureDetails=failure_details)
+    except (cp_client.exceptions.InvalidJobStateException,
+            cp_client.exceptions.JobNotFoundException) as e:
+        print(f'{job_id} is already complete: {e}')
+
+
+def get_output_variables(stack):
+    outputVariables = {}
+    if ('Outputs' in stack):
+        for output in stack['Outputs']:
+            key = output['OutputKey']
+            value = output['OutputValue']
+            outputVariables[key] = value
+    return outputVariables
+
+
+def complete_stack_job(cp_client, detail):
+    job_id = detail.get('client-request-token')
+    status = detail['status-details']['status']
+    if not job_id or status not in STACK_SUCCEEDED + STACK_FAILED:
+        return
+    params = get_job_params(cp_client, job_id)
+    if params is None:
+        return
+
+    # Nested stacks may carry the client request token of their root stack,
+    # only the stack of the job completes it
+    stack_id = detail['stack-id']
+    region, account_id = stack_id.split(':')[3:5]
+    cfn_client = boto3.client('cloudformation', region_name=region)
+    stack = cfn_client.describe_stacks(StackName=stack_id)['Stacks'][0]
+    if stack['StackName'] != params.get('stackName') or 'ParentId' in stack:
+        print(f'{stack_id} is not the stack of {job_id}')
+        return
+
+    if status in STACK_SUCCEEDED:
+        outputs = get_output_variables(stack)
+        # The stack is deployed, a registry failure is only logged
+        if params.get('publishOutputs', True):
+            try:
+                publish_outputs(
+                    boto3.client('ssm'), account_id, region,
+                    stack['StackName'], outputs)
+            except Exception as e:
+                print(f'Failed to publish the outputs of {stack["StackName"]}: {e}')
+        put_job_result(cp_client, job_id, outputVariables=outputs)
+    else:
+        reason = detail['status-details'].get('status-reason', '')
+        put_job_result(cp_client, job_id, failure_details={
+            'message': f'Stack Status: {status}\n{reason}'[:5000],
+            'type': 'JobFailed'
+        })
+
+
+def complete_stack_set_job(cp_client, detail):
+    job_id = detail.get('stack-set-operation-id')
+    status = detail['status-details']['status']
+    if not job_id or status not in OPERATION_SUCCEEDED + OPERATION_FAILED:
+        return
+    if get_job_params(cp_client, job_id) is None:
+        return
+
+    if status in OPERATION_SUCCEEDED:
+        put_job_result(cp_client, job_id)
+    else:
+        put_job_result(cp_client, job_id, failure_details={
+            'message': f'Operation: {status}',
+            'type': 'JobFailed'
+        })
+
+
+def lambda_handler(event, context):
+    """ Completes the jobs waiting for CloudFormation status change events
+
+    Invoked by an EventBridge rule on the stack and stack set operation
+    status change events of the pipeline account and region. The jobs of
+    create_update_stack and stack_set_action actions given the
+    'completionMode': 'event' user parameter are reported here instead of
+    polling through continuation invocations.
+    """
+    print(json.dumps(event))
+
+    cp_client = boto3.client('codepipeline')
+    if event['detail-type'] == 'CloudFormation Stack Status Change':
+        complete_stack_job(cp_client, event['detail'])
+    elif event['detail-type'] == 'CloudFormation StackSet Operation Status Change':
+        complete_stack_set_job(cp_client, event['detail'])
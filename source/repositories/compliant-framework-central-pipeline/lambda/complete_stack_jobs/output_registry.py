@@ -0,0 +1,74 @@
+######################################################################################################################
+#  Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.                                           #
+#                                                                                                                    #
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance    #
+#  with the License. A copy of the License is located at                                                             #
+#                                                                                                                    #
+#      http://www.apache.org/licenses/LICENSE-2.0                                                                    #
+#                                                                                                                    #
+#  or in the 'license' file accompanying this file. This file is distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES #
+#  OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions    #
+#  and limitations under the License.                                                                                #
+######################################################################################################################
+
+from concurrent.futures import ThreadPoolExecutor
+
+# Root of the registry of stack outputs, see publish_outputs
+REGISTRY_PATH = '/compliant/framework/stack-outputs'
+
+# Number of parameters written in parallel, SSM throttles writes early
+REGISTRY_CONCURRENCY = 4
+
+# Maximum number of names accepted by a single delete_parameters call
+DELETE_BATCH_SIZE = 10
+
+
+def get_registry_path(account_id, region, stack_name):
+    return f'{REGISTRY_PATH}/{account_id}/{region}/{stack_name}'
+
+
+def publish_outputs(ssm_client, account_id, region, stack_name, outputs):
+    """ Publishes the outputs of a stack to the registry
+
+    Each output is a String parameter named after its key under
+    REGISTRY_PATH/<account>/<region>/<stack name>, so consumers read the
+    outputs of any stack with one get_parameters_by_path in this account.
+    Only changed values are written, concurrently, and the parameters of
+    removed outputs are deleted. Empty values cannot be stored and are left
+    out.
+    """
+    path = get_registry_path(account_id, region, stack_name)
+
+    published = {}
+    paginator = ssm_client.get_paginator('get_parameters_by_path')
+    for page in paginator.paginate(Path=path):
+        for parameter in page['Parameters']:
+            published[parameter['Name']] = parameter['Value']
+
+    values = {
+        f'{path}/{key}': value for key, value in outputs.items() if value
+    }
+    changed = {
+        name: value for name, value in values.items()
+        if published.get(name) != value
+    }
+    removed = [name for name in published if name not in values]
+
+    with ThreadPoolExecutor(max_workers=REGISTRY_CONCURRENCY) as executor:
+        futures = [
+            executor.submit(
+                ssm_client.put_parameter,
+                Name=name,
+                Value=value,
+                Type='String',
+                Overwrite=True)
+            for name, value in changed.items()
+        ]
+        for future in futures:
+            future.result()
+
+    for index in range(0, len(removed), DELETE_BATCH_SIZE):
+        ssm_client.delete_parameters(
+            Names=removed[index:index + DELETE_BATCH_SIZE])
+
+    print(f'{path}: {len(changed)} outputs written, {len(removed)} deleted')
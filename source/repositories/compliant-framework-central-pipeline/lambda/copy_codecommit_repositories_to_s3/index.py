@@ -14,12 +14,569 @@
 import boto3
 import json
 import mimetypes
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+
+from concurrent.futures import ThreadPoolExecutor, wait
+from botocore.config import Config
+
+from snapshot_archive import get_member_index, load_index, materialize_nested_templates, save_index, SNAPSHOT_ARCHIVE_FILE_NAME
+
+# Number of blobs fetched from CodeCommit and uploaded to S3 in parallel,
+# shared by all the repositories of a job
+DEFAULT_CONCURRENCY = 16
+
+# Records the last synced commit and the blob of every path of a repository
+MANIFEST_FILE_NAME = '.manifest.json'
+
+# Progress of a sync interrupted by the time budget, see save_checkpoint
+PENDING_MANIFEST_FILE_NAME = '.manifest.pending.json'
+
+# Maximum number of keys accepted by a single delete_objects call
+DELETE_BATCH_SIZE = 1000
+
+# Time kept in reserve at the end of an invocation to complete the in flight
+# transfers and checkpoint the progress into a continuation token
+TIME_RESERVE_SECONDS = 30
+
+# Maximum length of a CodePipeline continuation token. Longer tokens are
+# stored in the bucket and referenced from the token.
+CONTINUATION_TOKEN_MAX_LENGTH = 2048
+
+# Clients are shared by all worker threads and re-used by warm invocations.
+# The connection pools are sized to the worker pool so that the workers do
+# not wait on each other for a connection.
+clients = {}
+
+
+def get_client(service, concurrency):
+    key = (service, concurrency)
+    if key not in clients:
+        clients[key] = boto3.client(
+            service,
+            config=Config(max_pool_connections=concurrency))
+    return clients[key]
+
+
+class TransferPool:
+    """ Worker pool shared by all the repositories of a job
+
+    While several repositories are syncing, each one is limited to its share
+    of the concurrency budget so that a large repository cannot starve the
+    others. The share grows as repositories complete.
+    """
+
+    def __init__(self, concurrency, repository_names):
+        self.concurrency = concurrency
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.condition = threading.Condition()
+        self.active = set(repository_names)
+        self.in_flight = {name: 0 for name in repository_names}
+        self.total_in_flight = 0
+
+    def get_share(self):
+        if not self.active:
+            return self.concurrency
+        return max(1, -(-self.concurrency // len(self.active)))
+
+    def submit(self, repository_name, fn, *args):
+        """ Submits a task, blocking until the repository has a free worker
+        """
+        with self.condition:
+            while (self.total_in_flight >= self.concurrency or
+                   self.in_flight[repository_name] >= self.get_share()):
+                self.condition.wait()
+            self.in_flight[repository_name] += 1
+            self.total_in_flight += 1
+
+        future = self.executor.submit(fn, *args)
+        future.add_done_callback(lambda f: self.release(repository_name))
+        return future
+
+    def release(self, repository_name):
+        with self.condition:
+            self.in_flight[repository_name] -= 1
+            self.total_in_flight -= 1
+            self.condition.notify_all()
+
+    def finish(self, repository_name):
+        """ Gives the share of a completed repository to the others
+        """
+        with self.condition:
+            self.active.discard(repository_name)
+            self.condition.notify_all()
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+def get_head_commit_id(codecommit_client, repository_name, branch_name):
+    response = codecommit_client.get_branch(
+        repositoryName=repository_name,
+        branchName=branch_name)
+    return response['branch']['commitId']
+
+
+def get_differences_page(codecommit_client, repository_name, state, next_token):
+    """ Gets a page of the differences between the last synced commit and the
+    commit being synced
+
+    Without a last synced commit every file is returned as an addition.
+    """
+    args = {'repositoryName': repository_name,
+            'afterCommitSpecifier': state['commitId']}
+    if state['lastCommitId'] is not None:
+        args['beforeCommitSpecifier'] = state['lastCommitId']
+    if next_token is not None:
+        args['nextToken'] = next_token
+    return codecommit_client.get_differences(**args)
+
+
+def iter_differences(codecommit_client, repository_name, state, next_token, cursor):
+    """ Yields the differences to apply, starting at a checkpoint
+
+    Each difference comes with the checkpoint of the difference following
+    it, None after the last one. Pages are requested lazily, the next one
+    only once the consumer is done with the current one, so at most one page
+    is held in memory.
+    """
+    while True:
+        response = get_differences_page(
+            codecommit_client, repository_name, state, next_token)
+        differences = response['differences']
+        page_next_token = response.get('nextToken')
+        for index in range(cursor, len(differences)):
+            if index + 1 < len(differences):
+                checkpoint = {'nextToken': next_token, 'cursor': index + 1}
+            elif page_next_token is not None:
+                checkpoint = {'nextToken': page_next_token, 'cursor': 0}
+            else:
+                checkpoint = None
+            yield differences[index], checkpoint
+
+        if page_next_token is None:
+            return
+        next_token = page_next_token
+        cursor = 0
+
+
+def collect_transfers(futures, stats, block):
+    """ Removes the completed transfers from the in flight set and accounts
+    for them in the stats
+
+    Waits for every transfer when block is set. Raises the error of a failed
+    transfer once the others have completed.
+    """
+    done, _ = wait(futures, timeout=None if block else 0)
+    futures -= done
+    for future in done:
+        if future.exception() is not None:
+            wait(futures)
+            raise future.exception()
+        stats['files'] += 1
+        stats['bytes'] += future.result()
+
+
+def apply_difference(difference, state):
+    """ Applies a difference to the path->blobId dictionary of the sync state
+
+    Returns the blob to upload, if any. Deleted paths are collected in the
+    state and removed once every difference has been applied.
+    """
+    before_blob = difference.get('beforeBlob')
+    after_blob = difference.get('afterBlob')
+
+    # Deleted or renamed files. A path can be re-added by another difference,
+    # possibly one applied earlier.
+    if before_blob is not None and (
+            after_blob is None or after_blob['path'] != before_blob['path']):
+        path = before_blob['path']
+        if path not in state['added']:
+            state['deleted'].add(path)
+
+    # Added or modified files. A change of the file mode alone does not
+    # change the blob so there is nothing to upload.
+    if after_blob is not None:
+        path = after_blob['path']
+        if state['lastCommitId'] is not None:
+            state['deleted'].discard(path)
+            state['added'].add(path)
+        if state['blobs'].get(path) != after_blob['blobId']:
+            state['blobs'][path] = after_blob['blobId']
+            return after_blob
+
+    return None
+
+
+def load_json(s3_client, bucket_name, key):
+    """ Loads a json object from the bucket, None if there is none
+    """
+    try:
+        response = s3_client.get_object(Bucket=bucket_name, Key=key)
+    except s3_client.exceptions.NoSuchKey:
+        return None
+    return json.loads(response['Body'].read())
+
+
+def save_json(s3_client, bucket_name, key, value, kms_key_id):
+    s3_client.put_object(
+        Bucket=bucket_name,
+        Key=key,
+        Body=json.dumps(value),
+        ContentType='application/json',
+        ServerSideEncryption='aws:kms',
+        SSEKMSKeyId=kms_key_id)
+
+
+def load_manifest(s3_client, bucket_name, repository_name):
+    """ Loads the manifest of the last sync, None if there is none
+    """
+    return load_json(s3_client, bucket_name,
+                     f'{repository_name}/{MANIFEST_FILE_NAME}')
+
+
+def save_manifest(s3_client, bucket_name, repository_name, commit_id, blobs, kms_key_id):
+    save_json(s3_client, bucket_name,
+              f'{repository_name}/{MANIFEST_FILE_NAME}',
+              {'commitId': commit_id, 'blobs': blobs}, kms_key_id)
+
+
+def load_state(s3_client, bucket_name, repository_name):
+    """ Loads the state of a sync interrupted by the time budget
+    """
+    state = load_json(s3_client, bucket_name,
+                      f'{repository_name}/{PENDING_MANIFEST_FILE_NAME}')
+    if state is None:
+        raise Exception(f'{repository_name} has no pending sync to resume')
+    state['added'] = set(state['added'])
+    state['deleted'] = set(state['deleted'])
+    return state
+
+
+def save_state(s3_client, bucket_name, repository_name, state, kms_key_id):
+    save_json(s3_client, bucket_name,
+              f'{repository_name}/{PENDING_MANIFEST_FILE_NAME}',
+              {
+                  'commitId': state['commitId'],
+                  'lastCommitId': state['lastCommitId'],
+                  'blobs': state['blobs'],
+                  'added': sorted(state['added']),
+                  'deleted': sorted(state['deleted'])
+              },
+              kms_key_id)
+
+
+def load_continuation_token(s3_client, bucket_name, continuation_token):
+    token = json.loads(continuation_token)
+    if 'checkpointKey' in token:
+        key = token['checkpointKey']
+        token = load_json(s3_client, bucket_name, key)
+        s3_client.delete_object(Bucket=bucket_name, Key=key)
+    return token
+
+
+def save_continuation_token(s3_client, bucket_name, token, kms_key_id):
+    """ Serializes the continuation token, storing it in the bucket when it
+    is too long for CodePipeline
+    """
+    continuation_token = json.dumps(token)
+    if len(continuation_token) > CONTINUATION_TOKEN_MAX_LENGTH:
+        key = f'.checkpoints/{uuid.uuid4()}.json'
+        save_json(s3_client, bucket_name, key, token, kms_key_id)
+        continuation_token = json.dumps({'checkpointKey': key})
+    return continuation_token
+
+
+def delete_keys(s3_client, bucket_name, keys):
+    """ Deletes the keys using the batch API, 1000 keys per call
+    """
+    for i in range(0, len(keys), DELETE_BATCH_SIZE):
+        response = s3_client.delete_objects(
+            Bucket=bucket_name,
+            Delete={
+                'Objects': [{'Key': key} for key in keys[i:i + DELETE_BATCH_SIZE]],
+                'Quiet': True
+            })
+        if response.get('Errors'):
+            raise Exception(f'Failed to delete objects: {response["Errors"]}')
+
+
+def delete_prefix(s3_client, bucket_name, prefix):
+    paginator = s3_client.get_paginator('list_objects_v2')
+    keys = []
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        keys += [item['Key'] for item in page.get('Contents', [])]
+    delete_keys(s3_client, bucket_name, keys)
+
+
+def copy_blob(codecommit_client, s3_client, repository_name, blob, bucket_name, kms_key_id):
+    """ Reads a file from the repository and uploads it to the s3 bucket
+
+    Returns the number of bytes copied.
+    """
+    path = blob['path']
+    content = (codecommit_client.get_blob(
+        repositoryName=repository_name, blobId=blob['blobId']))['content']
+
+    args = {
+        'Bucket': bucket_name,
+        'Body': content,
+        'Key': f'{repository_name}/{path}',
+        'ServerSideEncryption': 'aws:kms',
+        'SSEKMSKeyId': kms_key_id
+    }
+    # we have to guess the mime content-type of the files and
+    # provide it to S3 since S3 cannot do this on its own.
+    content_type = mimetypes.guess_type(path)[0]
+    if content_type is not None:
+        args['ContentType'] = content_type
+    s3_client.put_object(**args)
+
+    return len(content)
+
+
+def add_throughput(stats, start):
+    elapsed = max(time.time() - start, 0.001)
+    stats['seconds'] = round(elapsed, 3)
+    stats['filesPerSecond'] = round(stats['files'] / elapsed, 1)
+    stats['bytesPerSecond'] = round(stats['bytes'] / elapsed)
+
+
+def archive_blob(codecommit_client, repository_name, blob, zip, lock):
+    """ Reads a file from the repository and writes it to the archive
+
+    Returns the number of bytes archived.
+    """
+    content = (codecommit_client.get_blob(
+        repositoryName=repository_name, blobId=blob['blobId']))['content']
+    with lock:
+        zip.writestr(blob['path'], content)
+    return len(content)
+
+
+def publish_archive(pool, codecommit_client, s3_client, repository_name, params):
+    """ Publishes the branch head of a repository as a snapshot archive
+
+    The files are fetched by the workers of the pool and written to a single
+    compressed archive which is uploaded along with the index of its
+    members, instead of one object per file. The repository prefix is
+    emptied first, consumers extract the files they need from the archive.
+    An archive is always built within a single invocation.
+    """
+    start = time.time()
+    bucket_name = params['bucketName']
+    kms_key_id = params['kmsKeyId']
+
+    head_commit_id = get_head_commit_id(
+        codecommit_client, repository_name, params['branchName'])
+    print(f'{repository_name} head_commit_id: {head_commit_id}')
+
+    stats = {
+        'repositoryName': repository_name,
+        'commitId': head_commit_id,
+        'files': 0,
+        'deleted': 0,
+        'bytes': 0,
+        'complete': True
+    }
+
+    index = load_index(s3_client, bucket_name, repository_name)
+    if index is not None and index.get('commitId') == head_commit_id:
+        print(f'{repository_name} is already published')
+    else:
+        state = {'commitId': head_commit_id, 'lastCommitId': None}
+        lock = threading.Lock()
+        with tempfile.TemporaryFile() as archive_file:
+            with zipfile.ZipFile(archive_file, 'w', zipfile.ZIP_DEFLATED) as zip:
+                futures = set()
+                for difference, _ in iter_differences(
+                        codecommit_client, repository_name, state, None, 0):
+                    futures.add(pool.submit(
+                        repository_name, archive_blob, codecommit_client,
+                        repository_name, difference['afterBlob'], zip, lock))
+                    collect_transfers(futures, stats, False)
+                collect_transfers(futures, stats, True)
+
+            members = get_member_index(archive_file)
+            archive_file.seek(0)
+
+            delete_prefix(s3_client, bucket_name, f'{repository_name}/')
+            s3_client.upload_fileobj(
+                archive_file, bucket_name,
+                f'{repository_name}/{SNAPSHOT_ARCHIVE_FILE_NAME}',
+                ExtraArgs={
+                    'ContentType': 'application/zip',
+                    'ServerSideEncryption': 'aws:kms',
+                    'SSEKMSKeyId': kms_key_id
+                })
+            index = save_index(s3_client, bucket_name, repository_name,
+                               members, kms_key_id, {'commitId': head_commit_id})
+            materialize_nested_templates(
+                s3_client, bucket_name, repository_name, index)
+
+    add_throughput(stats, start)
+    return stats, None
+
+
+def start_sync(codecommit_client, s3_client, repository_name, params):
+    """ Creates the state of a new sync of the branch head
+
+    Returns the head commit id and the state, None when the branch head is
+    already synced.
+    """
+    bucket_name = params['bucketName']
+
+    head_commit_id = get_head_commit_id(
+        codecommit_client, repository_name, params['branchName'])
+    print(f'{repository_name} head_commit_id: {head_commit_id}')
+
+    manifest = None
+    if params.get('syncMode', 'full') == 'incremental':
+        manifest = load_manifest(s3_client, bucket_name, repository_name)
+
+    if manifest is not None:
+        if manifest['commitId'] == head_commit_id:
+            return head_commit_id, None
+
+        print(f'{repository_name} last_commit_id: {manifest["commitId"]}')
+        try:
+            codecommit_client.get_commit(
+                repositoryName=repository_name,
+                commitId=manifest['commitId'])
+        except codecommit_client.exceptions.CommitDoesNotExistException:
+            # The branch history was rewritten, fall back to a full sync
+            print(f'{repository_name} last synced commit no longer exists')
+            manifest = None
+
+    if manifest is None:
+        delete_prefix(s3_client, bucket_name, f'{repository_name}/')
+
+    return head_commit_id, {
+        'commitId': head_commit_id,
+        'lastCommitId': manifest['commitId'] if manifest else None,
+        'blobs': manifest['blobs'] if manifest else {},
+        'added': set(),
+        'deleted': set()
+    }
+
+
+def copy_repository(pool, codecommit_client, s3_client, repository_name, params, checkpoint, deadline):
+    """ Syncs the branch of a repository into the s3 bucket
+
+    In full mode the repository prefix is emptied and every file is copied.
+    In incremental mode only the files changed since the commit recorded in
+    the manifest are copied, and nothing is done when the branch has not
+    moved. Each file is fetched and uploaded by a worker of the pool, so the
+    downloads of some files overlap with the uploads of others.
+
+    A sync still running at the deadline is interrupted once its in flight
+    transfers complete. Its state is saved in the bucket and the returned
+    checkpoint (the token of the differences page and the number of
+    differences of that page already applied) resumes it. The returned
+    checkpoint is None once the sync is complete.
+
+    Enumeration and transfers form a pipeline: the first transfers start
+    with the first page and memory does not grow with the repository size.
+    """
+    start = time.time()
+    bucket_name = params['bucketName']
+    kms_key_id = params['kmsKeyId']
+
+    if checkpoint is None:
+        commit_id, state = start_sync(
+            codecommit_client, s3_client, repository_name, params)
+        checkpoint = {'nextToken': None, 'cursor': 0}
+    else:
+        state = load_state(s3_client, bucket_name, repository_name)
+        commit_id = state['commitId']
+        print(f'{repository_name} resuming at {json.dumps(checkpoint)}')
+
+    stats = {
+        'repositoryName': repository_name,
+        'commitId': commit_id,
+        'files': 0,
+        'deleted': 0,
+        'bytes': 0,
+        'complete': True
+    }
+
+    if state is None:
+        print(f'{repository_name} is already synced')
+        checkpoint = None
+    else:
+        # Differences stream from the CodeCommit pages into the transfer
+        # pool. Submitting blocks while the repository has no free worker,
+        # which in turn holds back the request of the next page.
+        futures = set()
+        for difference, next_checkpoint in iter_differences(
+                codecommit_client, repository_name, state,
+                checkpoint['nextToken'], checkpoint['cursor']):
+            if time.time() >= deadline:
+                complete = False
+                break
+
+            blob = apply_difference(difference, state)
+            if blob is not None:
+                futures.add(pool.submit(
+                    repository_name, copy_blob, codecommit_client, s3_client,
+                    repository_name, blob, bucket_name, kms_key_id))
+            collect_transfers(futures, stats, False)
+            checkpoint = next_checkpoint
+        else:
+            complete = True
+        collect_transfers(futures, stats, True)
+
+        if not complete:
+            save_state(s3_client, bucket_name, repository_name, state, kms_key_id)
+            stats['complete'] = False
+        else:
+            delete_paths = sorted(state['deleted'])
+            for path in delete_paths:
+                state['blobs'].pop(path, None)
+            delete_keys(s3_client, bucket_name,
+                        [f'{repository_name}/{path}' for path in delete_paths] +
+                        [f'{repository_name}/{PENDING_MANIFEST_FILE_NAME}'])
+            stats['deleted'] = len(delete_paths)
+
+            save_manifest(s3_client, bucket_name, repository_name,
+                          state['commitId'], state['blobs'], kms_key_id)
+            checkpoint = None
+
+    add_throughput(stats, start)
+    return stats, checkpoint
+
+
+def sync_repository(pool, codecommit_client, s3_client, repository_name, params, checkpoint, deadline):
+    try:
+        if params.get('publishMode', 'files') == 'archive':
+            return publish_archive(pool, codecommit_client, s3_client,
+                                   repository_name, params)
+        return copy_repository(pool, codecommit_client, s3_client,
+                               repository_name, params, checkpoint, deadline)
+    finally:
+        pool.finish(repository_name)
+
+
+def get_summary(stats_list):
+    """ Formats the per repository throughput for the job execution details
+    """
+    lines = [f'{stats["repositoryName"]}@{stats["commitId"][:7]}: '
+             f'{stats["files"]} files, {stats["bytes"]} bytes, '
+             f'{stats["deleted"]} deleted in {stats["seconds"]}s '
+             f'({stats["filesPerSecond"]} files/s, '
+             f'{stats["bytesPerSecond"]} bytes/s)'
+             f'{"" if stats["complete"] else " - in progress"}'
+             for stats in stats_list]
+    # The execution details summary is limited to 2048 characters
+    return '\n'.join(lines)[:2048]
 
 
 def lambda_handler(event, context):
 
     cp_client = boto3.client('codepipeline')
-    codecommit_client = boto3.client('codecommit')
 
     try:
         print(event)
@@ -34,49 +591,83 @@ def lambda_handler(event, context):
             job_data['actionConfiguration']['configuration']['UserParameters'])
         print(params)
 
-        # pylint: disable=E1101
-        bucket = boto3.resource('s3').Bucket(params['bucketName'])
-
-        for repository_name in params['repositoryNames']:
-            bucket.objects.filter(Prefix=repository_name).delete()
-
-            branch_name = params['branchName']
-
-            # get blob_list
-            args = {'repositoryName': repository_name,
-                    'afterCommitSpecifier': branch_name}
-            response = codecommit_client.get_differences(**args)
-            blob_list = [difference['afterBlob']
-                         for difference in response['differences']]
-            while 'nextToken' in response:
-                args['nextToken'] = response['nextToken']
-                response = codecommit_client.get_differences(**args)
-                blob_list += [difference['afterBlob']
-                              for difference in response['differences']]
-
-            # reads each file in the branch and uploads it to the s3 bucket
-            for blob in blob_list:
-                path = blob['path']
-                content = (codecommit_client.get_blob(
-                    repositoryName=repository_name, blobId=blob['blobId']))['content']
-                # we have to guess the mime content-type of the files and
-                # provide it to S3 since S3 cannot do this on its own.
-                content_type = mimetypes.guess_type(path)[0]
-                if content_type is not None:
-                    bucket.put_object(
-                        Body=(content),
-                        Key=f'{repository_name}/{path}',
-                        ContentType=content_type,
-                        ServerSideEncryption='aws:kms',
-                        SSEKMSKeyId=params['kmsKeyId'])
-                else:
-                    bucket.put_object(
-                        Body=(content),
-                        Key=f'{repository_name}/{path}',
-                        ServerSideEncryption='aws:kms',
-                        SSEKMSKeyId=params['kmsKeyId'])
-
-        cp_client.put_job_success_result(jobId=job_id)
+        concurrency = int(params.get('concurrency', DEFAULT_CONCURRENCY))
+        codecommit_client = get_client('codecommit', concurrency)
+        s3_client = get_client('s3', concurrency)
+
+        # Stop starting new transfers when the remaining time is needed to
+        # checkpoint the progress
+        deadline = time.time() + \
+            context.get_remaining_time_in_millis() / 1000 - TIME_RESERVE_SECONDS
+
+        # The continuation token holds a checkpoint for each repository still
+        # to sync, keyed by its index in the repository names
+        repository_names = list(dict.fromkeys(params['repositoryNames']))
+        if 'continuationToken' in job_data:
+            token = load_continuation_token(
+                s3_client, params['bucketName'], job_data['continuationToken'])
+            checkpoints = {repository_names[int(index)]: checkpoint
+                           for index, checkpoint in token['checkpoints'].items()}
+            failures = token['failures']
+        else:
+            checkpoints = {name: None for name in repository_names}
+            failures = []
+        print(f'checkpoints: {json.dumps(checkpoints)}')
+
+        # Repositories are synced concurrently, their files are transferred
+        # by a single pool sharing the concurrency budget
+        pool = TransferPool(concurrency, list(checkpoints))
+        with ThreadPoolExecutor(max_workers=len(checkpoints)) as executor:
+            futures = {
+                repository_name: executor.submit(
+                    sync_repository, pool, codecommit_client, s3_client,
+                    repository_name, params, checkpoint, deadline)
+                for repository_name, checkpoint in checkpoints.items()
+            }
+
+            # A failed repository does not abort its siblings
+            stats_list = []
+            next_checkpoints = {}
+            for repository_name, future in futures.items():
+                try:
+                    stats, checkpoint = future.result()
+                    print(json.dumps(stats))
+                    stats_list.append(stats)
+                    if checkpoint is not None:
+                        index = str(repository_names.index(repository_name))
+                        next_checkpoints[index] = checkpoint
+                except Exception as e:
+                    print(f'{repository_name} failed: {e}')
+                    failures.append(f'{repository_name}: {e}')
+        pool.shutdown()
+
+        if next_checkpoints:
+            print(f'next_checkpoints: {json.dumps(next_checkpoints)}')
+            cp_client.put_job_success_result(
+                jobId=job_id,
+                continuationToken=save_continuation_token(
+                    s3_client, params['bucketName'],
+                    {'checkpoints': next_checkpoints, 'failures': failures},
+                    params['kmsKeyId']),
+                executionDetails={
+                    'summary': get_summary(stats_list)
+                }
+            )
+        elif failures:
+            cp_client.put_job_failure_result(
+                jobId=job_id, failureDetails={
+                    # The failure message is limited to 5000 characters
+                    'message': '\n'.join(failures + [get_summary(stats_list)])[:5000],
+                    'type': 'JobFailed'
+                }
+            )
+        else:
+            cp_client.put_job_success_result(
+                jobId=job_id,
+                executionDetails={
+                    'summary': get_summary(stats_list)
+                }
+            )
 
     except Exception as e:
         # If any other exceptions which we didn't expect are raised
@@ -13,8 +13,658 @@
 
 import os
 import boto3
+import hashlib
 import json
 import mimetypes
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from boto3.session import Session
+from botocore.exceptions import ClientError
+
+from output_registry import publish_outputs
+from parameter_resolver import resolve_parameters
+from session_broker import SessionBroker
+from snapshot_archive import get_referenced_paths, materialize_template, NESTED_STACK_TYPE
+from template_validation import check_template, get_template_location, head_template, validate_template
+
+# Assumed-role sessions, re-used by warm invocations
+broker = SessionBroker()
+
+# Clients of the pipeline account by region, re-used by warm invocations.
+# Stacks are started from several threads, clients are only created from
+# the session under the lock.
+session = Session()
+cfn_clients = {}
+cfn_clients_lock = threading.Lock()
+
+# Stack tag holding the fingerprint of the last update, see get_fingerprint
+FINGERPRINT_TAG_KEY = 'compliant-framework:fingerprint'
+
+# The continuation token is limited to 2048 characters
+CONTINUATION_TOKEN_MAX_LENGTH = 2048
+
+# Stack statuses ending a stack operation
+STACK_SUCCEEDED = [
+    'CREATE_COMPLETE',
+    'UPDATE_COMPLETE'
+]
+STACK_FAILED = [
+    'UPDATE_ROLLBACK_COMPLETE',
+    'ROLLBACK_COMPLETE',
+    'CREATE_FAILED',
+    'ROLLBACK_FAILED',
+    'DELETE_FAILED',
+    'UPDATE_ROLLBACK_FAILED'
+]
+
+# User parameters inherited by the stacks of a graph, see get_stack_graph
+GRAPH_DEFAULTS = [
+    'account',
+    'region',
+    'bucketRegionalDomainName',
+    'templatePrefix',
+    'capabilities',
+    'publishOutputs'
+]
+
+# Number of stacks of a graph started concurrently
+START_CONCURRENCY = 8
+
+# Targets of a fan-out deployment, the state of each one is kept in the
+# continuation token
+MAX_TARGETS = 40
+
+
+def get_nested_etags(s3_client, template_url):
+    """ ETags of the nested templates of a template, by path
+
+    Nested templates are looked up, recursively, among the objects of the
+    repository of the template, see get_referenced_paths.
+    """
+    bucket_name, key = get_template_location(template_url)
+    prefix, _, path = key.partition('/')
+
+    def get_body(path):
+        return s3_client.get_object(
+            Bucket=bucket_name, Key=f'{prefix}/{path}')['Body'].read()
+
+    bodies = {path: get_body(path)}
+    if NESTED_STACK_TYPE.encode('utf-8') not in bodies[path]:
+        return {}
+
+    etags = {}
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=f'{prefix}/'):
+        for content in page.get('Contents', []):
+            etags[content['Key'][len(prefix) + 1:]] = content['ETag']
+
+    nested = {}
+    pending = [path]
+    while pending:
+        for referenced in get_referenced_paths(bodies[pending.pop()], etags):
+            if referenced not in bodies:
+                nested[referenced] = etags[referenced]
+                bodies[referenced] = get_body(referenced)
+                pending.append(referenced)
+    return nested
+
+
+def get_fingerprint(etag, parameters, capabilities, nested_etags):
+    """ Fingerprint of a stack update
+
+    Digest of the ETag of the template object, and of its nested templates
+    if any, the resolved parameters and the capabilities. Unchanged members
+    keep their object, and ETag, when a repository is expanded.
+    """
+    fingerprint = {
+        'template': etag,
+        'parameters': parameters,
+        'capabilities': capabilities
+    }
+    if nested_etags:
+        fingerprint['nested'] = nested_etags
+    return hashlib.sha256(json.dumps(
+        fingerprint, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def get_tags(stack, fingerprint):
+    """Tags of the stack with the fingerprint replaced."""
+    tags = [
+        tag for tag in stack.get('Tags', [])
+        if tag['Key'] != FINGERPRINT_TAG_KEY
+    ]
+    tags.append({'Key': FINGERPRINT_TAG_KEY, 'Value': fingerprint})
+    return tags
+
+
+def get_new_events(cfn_client, stack_id, request_token, event_id):
+    """ Events of a stack operation newer than the cursor, oldest first
+
+    Every event of an operation carries the ClientRequestToken the operation
+    was started with. Events are listed newest first, paging stops at the
+    cursor or at the first event of an older operation.
+    """
+    events = []
+    paginator = cfn_client.get_paginator('describe_stack_events')
+    for page in paginator.paginate(StackName=stack_id):
+        for event in page['StackEvents']:
+            if event['EventId'] == event_id or \
+                    event.get('ClientRequestToken') != request_token:
+                return events[::-1]
+            events.append(event)
+    return events[::-1]
+
+
+def is_cleaning_up(stack_status):
+    """ Whether the update succeeded and old resources are being deleted
+
+    Resource failures of a rollback, and of its cleanup, still count.
+    """
+    return stack_status == 'UPDATE_COMPLETE_CLEANUP_IN_PROGRESS'
+
+
+def get_first_failure(events, stack_id):
+    """ Describe the first failed resource of the events, None if none failed
+
+    Resources failing to be deleted during the cleanup of an update do not
+    fail it, events past the start of the cleanup are ignored.
+    """
+    for event in events:
+        if event.get('PhysicalResourceId') == stack_id and \
+                is_cleaning_up(event['ResourceStatus']):
+            return None
+        if event['ResourceStatus'].endswith('_FAILED') and \
+                event.get('PhysicalResourceId') != stack_id:
+            return f'{event["LogicalResourceId"]} ({event["ResourceType"]}) ' \
+                f'{event["ResourceStatus"]}: {event.get("ResourceStatusReason", "")}'
+    return None
+
+
+def get_output_variables(stack):
+    outputVariables = {}
+    if ('Outputs' in stack):
+        for output in stack['Outputs']:
+            key = output['OutputKey']
+            value = output['OutputValue']
+            outputVariables[key] = value
+    return outputVariables
+
+
+def complete_stack(ssm_client, params, stack):
+    """ Outputs of a finished stack
+
+    The outputs are published to the registry of the account and region of
+    the stack, unless the publishOutputs user parameter is false. The stack
+    is deployed by then, a registry failure is only logged; the registry is
+    brought up to date by the next completion of the stack.
+    """
+    outputs = get_output_variables(stack)
+    if params.get('publishOutputs', True):
+        try:
+            publish_outputs(
+                ssm_client, params['account'], params['region'],
+                stack['StackName'], outputs)
+        except Exception as e:
+            print(f'Failed to publish the outputs of {stack["StackName"]}: {e}')
+    return outputs
+
+
+def get_cfn_client(current_account_id, partition, account_id, region):
+    if current_account_id == account_id:
+        with cfn_clients_lock:
+            if region not in cfn_clients:
+                cfn_clients[region] = session.client(
+                    'cloudformation', region_name=region)
+            return cfn_clients[region]
+    # Assume Role
+    return broker.client(
+        'cloudformation', partition, account_id, region=region)
+
+
+def get_parameters(params, ssm_params):
+    """Stack parameters from the overrides, then the values resolved from SSM."""
+    parameter_dict = {}
+    if 'parameterOverrides' in params:
+        for key in params['parameterOverrides']:
+            parameter_dict[key] = params['parameterOverrides'][key]
+    for key in ssm_params:
+        if not key in parameter_dict:
+            parameter_dict[key] = ssm_params[key]
+    parameters = []
+    for key in parameter_dict:
+        value = parameter_dict[key]
+        if isinstance(value, str):
+            parameters.append(
+                {
+                    'ParameterKey': key,
+                    'ParameterValue': value
+                }
+            )
+        elif isinstance(value, dict):
+            parameters.append(
+                {
+                    'ParameterKey': key,
+                    'ParameterValue': json.dumps(value)
+                }
+            )
+    print('parameters:')
+    print(json.dumps(parameters, default=str))
+    return parameters
+
+
+def dump_continuation_token(token, ssm_params):
+    """ Serializes a continuation token with the values resolved from SSM
+
+    Continuations re-use the values instead of reading SSM again. Values
+    which do not fit in the token are resolved again, usually from the
+    cache of the warm function.
+    """
+    continuation_token = json.dumps({**token, 'ssm': ssm_params})
+    if len(continuation_token) <= CONTINUATION_TOKEN_MAX_LENGTH:
+        return continuation_token
+    return json.dumps(token)
+
+
+def get_capabilities(params):
+    capabilities = []
+    if 'capabilities' in params:
+        capabilities.append(params['capabilities'])
+    print('capabilities:')
+    print(capabilities)
+    return capabilities
+
+
+def get_template_url(params):
+    bucket_domain = params['bucketRegionalDomainName']
+    prefix = params['templatePrefix']
+    path = params['templatePath']
+    template_url = f'https://{bucket_domain}/{prefix}/{path}'
+    print(f'template_url: {template_url}')
+    return template_url
+
+
+def preflight_stack(cfn_client, s3_client, template_url, parameters, capabilities):
+    """ Validates the template of a stack before any stack operation
+
+    Returns the ETag of the template. Raises a ValueError if the template is
+    invalid or cannot be deployed with the parameters and capabilities.
+    """
+    # Extract the template if its repository is published as a
+    # snapshot archive
+    materialize_template(s3_client, template_url)
+
+    template = head_template(s3_client, template_url)
+    check_template(
+        validate_template(
+            cfn_client, s3_client, template_url, template['ETag'],
+            template.get('SSEKMSKeyId')),
+        parameters, capabilities)
+    return template['ETag']
+
+
+def start_stack(cfn_client, s3_client, stack_name, template_url, parameters, capabilities, request_token):
+    """ Creates or updates a stack
+
+    Returns the outcome and the stack:
+        DELETING : The stack was in ROLLBACK_COMPLETE, which cannot be
+          updated, and is being deleted to be created again.
+        UNCHANGED : The template, parameters and capabilities of the stack
+          are unchanged.
+        STARTED : The stack is being created or updated, only its StackId
+          is returned.
+
+    Raises a ValueError, before any stack operation, if the template is
+    invalid or cannot be deployed with the parameters and capabilities.
+    """
+    etag = preflight_stack(
+        cfn_client, s3_client, template_url, parameters, capabilities)
+
+    fingerprint = get_fingerprint(
+        etag, parameters, capabilities,
+        get_nested_etags(s3_client, template_url))
+    print(f'fingerprint: {fingerprint}')
+
+    existing_stack = None
+    try:
+        # If the stack does not exist, an AmazonCloudFormationException
+        # is returned.
+        response = cfn_client.describe_stacks(StackName=stack_name)
+        print(json.dumps(response, default=str))
+
+        for stack in response['Stacks']:
+            if (stack['StackName'] == stack_name):
+                existing_stack = stack
+                break
+    except:
+        pass
+
+    if existing_stack is None:
+        print('Stack does not exists - creating stack')
+        response = cfn_client.create_stack(
+            StackName=stack_name,
+            TemplateURL=template_url,
+            Parameters=parameters,
+            Capabilities=capabilities,
+            Tags=get_tags({}, fingerprint),
+            ClientRequestToken=request_token
+        )
+        print(json.dumps(response, default='str'))
+        return 'STARTED', response
+
+    if existing_stack['StackStatus'] == 'ROLLBACK_COMPLETE':
+        response = cfn_client.delete_stack(
+            StackName=stack_name
+        )
+        print('delete_stack response:')
+        print(json.dumps(response, default=str))
+        return 'DELETING', existing_stack
+
+    if existing_stack['StackStatus'] in STACK_SUCCEEDED and \
+            {'Key': FINGERPRINT_TAG_KEY, 'Value': fingerprint} in existing_stack.get('Tags', []):
+        print('Stack is up to date - skipping update')
+        return 'UNCHANGED', existing_stack
+
+    print('Stack exists - updating stack')
+    try:
+        response = cfn_client.update_stack(
+            StackName=stack_name,
+            TemplateURL=template_url,
+            Parameters=parameters,
+            Capabilities=capabilities,
+            Tags=get_tags(existing_stack, fingerprint),
+            ClientRequestToken=request_token
+        )
+    except ClientError as e:
+        if 'No updates are to be performed' not in str(e):
+            raise
+        print('No updates are to be performed')
+        return 'UNCHANGED', existing_stack
+    return 'STARTED', response
+
+
+def get_stack_graph(params):
+    """ Stacks of a graph deployment
+
+    The 'stacks' user parameter maps a name to the user parameters of each
+    stack, inheriting GRAPH_DEFAULTS. 'dependsOn' lists the stacks to
+    complete first and 'parameterOutputs' maps a parameter to the output of
+    another stack, as 'name.OutputKey', which it depends on as well.
+    """
+    stacks = {}
+    for name, spec in params['stacks'].items():
+        stack = {key: params[key] for key in GRAPH_DEFAULTS if key in params}
+        stack['stackName'] = name
+        stack.update(spec)
+
+        depends_on = set(spec.get('dependsOn', []))
+        for source in spec.get('parameterOutputs', {}).values():
+            depends_on.add(source.split('.')[0])
+        unknown = depends_on - set(params['stacks'])
+        if unknown:
+            raise ValueError(f'{name} depends on unknown stacks {sorted(unknown)}')
+        stack['dependsOn'] = sorted(depends_on)
+        stacks[name] = stack
+
+    # Peel off the stacks without pending dependencies, what is left is
+    # part of a cycle
+    pending = set(stacks)
+    while True:
+        ready = {
+            name for name in pending
+            if not pending.intersection(stacks[name]['dependsOn'])
+        }
+        if not ready:
+            break
+        pending -= ready
+    if pending:
+        raise ValueError(f'Stacks {sorted(pending)} depend on each other')
+
+    return stacks
+
+
+def get_target_graph(params):
+    """ Graph of a fan-out deployment
+
+    The 'targets' user parameter lists the accounts and regions to deploy
+    the stack to, as {'account', 'region'} with optional
+    'parameterOverrides' merged over the shared ones. Each target is a
+    stack of the graph, without dependencies, named '<account>-<region>'.
+    """
+    targets = params['targets']
+    if len(targets) > MAX_TARGETS:
+        raise ValueError(
+            f'{len(targets)} targets, at most {MAX_TARGETS} are supported')
+
+    shared = {
+        key: value for key, value in params.items()
+        if key not in ['targets', 'stacks']
+    }
+    stacks = {}
+    for target in targets:
+        name = f'{target["account"]}-{target["region"]}'
+        if name in stacks:
+            raise ValueError(f'Target {name} is listed twice')
+        stacks[name] = {
+            **shared,
+            **target,
+            'parameterOverrides': {
+                **params.get('parameterOverrides', {}),
+                **target.get('parameterOverrides', {})
+            }
+        }
+    return {'stacks': stacks}
+
+
+def deploy_stack_graph(cp_client, ssm_client, s3_client, get_client, job_id, params, continuation_token):
+    """ Deploys a graph of stacks in one action
+
+    Every stack whose dependencies are complete is created or updated right
+    away, so the stacks deploy concurrently and the action takes as long as
+    the critical path of the graph. The continuation token records the state
+    of each stack started: DELETING, WAITING or COMPLETE. The first failed
+    stack, or failed resource, fails the action; stacks already running are
+    left to finish.
+
+    A fan-out deployment, see get_target_graph, returns the outputs of each
+    target as '<account>-<region>_<OutputKey>'.
+    """
+    # Outputs of a fan-out deployment are prefixed with their target
+    fan_out = 'targets' in params
+    stacks = get_stack_graph(get_target_graph(params) if fan_out else params)
+    names = sorted(stacks)
+
+    if continuation_token is None:
+        states = {}
+        request_token = job_id
+        ssm_params = {
+            name: resolve_parameters(ssm_client, stacks[name])
+            for name in names
+        }
+        # Validate every template up front, outputs of the dependencies
+        # are not known yet and only count as given parameters
+        for name in names:
+            stack = stacks[name]
+            overrides = {
+                **{key: '' for key in stack.get('parameterOutputs', {})},
+                **stack.get('parameterOverrides', {})
+            }
+            try:
+                preflight_stack(
+                    get_client(stack['account'], stack['region']),
+                    s3_client,
+                    get_template_url(stack),
+                    get_parameters(
+                        {**stack, 'parameterOverrides': overrides},
+                        ssm_params[name]),
+                    get_capabilities(stack))
+            except ValueError as e:
+                raise ValueError(f'{name}: {e}')
+    else:
+        states = continuation_token['stacks']
+        request_token = continuation_token['request_token']
+        ssm_params = continuation_token.get('ssm', {})
+    print(f'states: {json.dumps(states)}')
+
+    # Last event read of each stack operation, see get_new_events. Cursors
+    # which do not fit in the continuation token are read from the start of
+    # the operation again.
+    event_ids = {}
+    if continuation_token is not None:
+        event_ids = continuation_token.get('events', {})
+
+    outputs = {}
+    failures = []
+
+    def get_outputs(name):
+        if name not in outputs:
+            stack = stacks[name]
+            outputs[name] = get_output_variables(
+                get_client(stack['account'], stack['region']).describe_stacks(
+                    StackName=stack['stackName'])['Stacks'][0])
+        return outputs[name]
+
+    # Poll the stacks started by the previous invocations
+    for name, state in list(states.items()):
+        stack = stacks[name]
+        cfn_client = get_client(stack['account'], stack['region'])
+        try:
+            described = cfn_client.describe_stacks(
+                StackName=stack['stackName'])['Stacks'][0]
+            stack_status = described['StackStatus']
+        except ClientError as e:
+            # Deleted, a deleted stack is only described by its id
+            if e.response['Error']['Code'] != 'ValidationError' or \
+                    'does not exist' not in e.response['Error']['Message']:
+                raise
+            described = None
+            stack_status = 'DELETE_COMPLETE'
+        print(f'{name}: {state} {stack_status}')
+
+        if state == 'DELETING':
+            if stack_status == 'DELETE_COMPLETE':
+                del states[name]
+            elif stack_status == 'DELETE_FAILED':
+                failures.append(f'{name}: Stack Status: {stack_status}')
+
+        elif state == 'WAITING':
+            if described is None:
+                failures.append(f'{name}: Stack does not exist')
+                continue
+            if stack_status in STACK_SUCCEEDED:
+                states[name] = 'COMPLETE'
+                event_ids.pop(name, None)
+                outputs[name] = complete_stack(ssm_client, stack, described)
+                continue
+
+            events = get_new_events(
+                cfn_client, described['StackId'],
+                f'{request_token}-{names.index(name)}', event_ids.get(name))
+            if events:
+                event_ids[name] = events[-1]['EventId']
+            failure = get_first_failure(events, described['StackId'])
+            if stack_status in STACK_FAILED or \
+                    (failure is not None and not is_cleaning_up(stack_status)):
+                failures.append(
+                    f'{name}: Stack Status: {stack_status}\n{failure or ""}')
+
+    def start(name):
+        stack = stacks[name]
+
+        # Wire the outputs of the dependencies into the parameters
+        overrides = dict(stack.get('parameterOverrides', {}))
+        for key, source in stack.get('parameterOutputs', {}).items():
+            dependency, output_key = source.split('.', 1)
+            overrides[key] = get_outputs(dependency)[output_key]
+
+        return start_stack(
+            get_client(stack['account'], stack['region']),
+            s3_client,
+            stack['stackName'],
+            get_template_url(stack),
+            get_parameters(
+                {**stack, 'parameterOverrides': overrides},
+                ssm_params[name] if name in ssm_params
+                else resolve_parameters(ssm_client, stack)),
+            get_capabilities(stack),
+            f'{request_token}-{names.index(name)}')
+
+    # Start the stacks whose dependencies are complete, concurrently.
+    # Unchanged stacks complete at once and may unblock others.
+    started = True
+    while started and not failures:
+        started = False
+        ready = [
+            name for name in names
+            if name not in states and all(
+                states.get(dependency) == 'COMPLETE'
+                for dependency in stacks[name]['dependsOn'])
+        ]
+        if not ready:
+            break
+
+        # Outputs of the dependencies are read before starting the stacks
+        for name in ready:
+            for source in stacks[name].get('parameterOutputs', {}).values():
+                get_outputs(source.split('.', 1)[0])
+
+        with ThreadPoolExecutor(max_workers=START_CONCURRENCY) as executor:
+            results = list(executor.map(start, ready))
+
+        for name, (result, described) in zip(ready, results):
+            print(f'{name}: {result}')
+            if result == 'UNCHANGED':
+                states[name] = 'COMPLETE'
+                outputs[name] = complete_stack(
+                    ssm_client, stacks[name], described)
+                started = True
+            elif result == 'DELETING':
+                states[name] = 'DELETING'
+            else:
+                states[name] = 'WAITING'
+
+    if failures:
+        cp_client.put_job_failure_result(
+            jobId=job_id,
+            failureDetails={
+                'message': '\n'.join(failures)[:5000],
+                'type': 'JobFailed'
+            }
+        )
+    elif all(states.get(name) == 'COMPLETE' for name in names):
+        outputVariables = {}
+        for name in names:
+            for key, value in get_outputs(name).items():
+                outputVariables[f'{name}_{key}' if fan_out else key] = value
+        cp_client.put_job_success_result(
+            jobId=job_id,
+            outputVariables=outputVariables
+        )
+    else:
+        print(f'states: {json.dumps(states)}')
+        token = {
+            'phase': 'GRAPH',
+            'request_token': request_token,
+            'stacks': states
+        }
+        pending_ssm_params = {
+            name: values for name, values in ssm_params.items()
+            if name not in states
+        }
+        continuation_token = dump_continuation_token({
+            **token,
+            'events': {
+                name: event_id for name, event_id in event_ids.items()
+                if states.get(name) == 'WAITING'
+            }
+        }, pending_ssm_params)
+        if len(continuation_token) > CONTINUATION_TOKEN_MAX_LENGTH:
+            continuation_token = dump_continuation_token(
+                token, pending_ssm_params)
+        cp_client.put_job_success_result(
+            jobId=job_id,
+            continuationToken=continuation_token
+        )
 
 
 def lambda_handler(event, context):
@@ -50,34 +700,88 @@ def lambda_handler(event, context):
             partition = 'aws'
         print(f'partition: {partition}')
 
+        # Graph of stacks, or one stack deployed to many targets - see
+        # deploy_stack_graph
+        if 'stacks' in params or 'targets' in params:
+            continuation_token = None
+            if 'continuationToken' in job_data:
+                continuation_token = json.loads(
+                    job_data['continuationToken'])
+            deploy_stack_graph(
+                cp_client,
+                ssm_client,
+                boto3.client('s3'),
+                lambda account, region: get_cfn_client(
+                    current_account_id, partition, account, region),
+                job_id,
+                params,
+                continuation_token)
+            return
+
         account_id = params['account']
         region = params['region']
-        if current_account_id == account_id:
-            cfn_client = boto3.client('cloudformation',
-                                      region_name=region)
-        else:
-            # Assume Role
-            role_arn = f'arn:{partition}:iam::{account_id}:role/CompliantFrameworkAccountAccessRole'
-            assumed_role = sts_client.assume_role(
-                RoleArn=role_arn,
-                RoleSessionName='CompliantFramework'
-            )
-            cfn_client = boto3.client(
-                'cloudformation',
-                aws_access_key_id=assumed_role['Credentials']['AccessKeyId'],
-                aws_secret_access_key=assumed_role['Credentials']['SecretAccessKey'],
-                aws_session_token=assumed_role['Credentials']['SessionToken'],
-                region_name=region
-            )
-
+        cfn_client = get_cfn_client(
+            current_account_id, partition, account_id, region)
+
+        # The continuation token records the phase of the action:
+        #     DELETING : A stack in ROLLBACK_COMPLETE, which cannot be
+        #       updated, is being deleted before being created again.
+        #     CREATING : The stack is created or updated.
+        #     WAITING : The stack operation is running.
+        phase = 'CREATING'
+        continuation_token = {}
         if 'continuationToken' in job_data:
             continuation_token = json.loads(job_data['continuationToken'])
+            phase = continuation_token.get('phase', 'WAITING')
+        print(f'phase: {phase}')
+
+        if phase == 'DELETING':
+            # A deleted stack is only described by its id
+            stack_id = continuation_token['stack_id']
+            stack_status = cfn_client.describe_stacks(
+                StackName=stack_id)['Stacks'][0]['StackStatus']
+            print(f'stack_status: {stack_status}')
+
+            # Deleted - Create the stack again
+            if stack_status == 'DELETE_COMPLETE':
+                phase = 'CREATING'
+
+            # Failed - Done.
+            elif stack_status == 'DELETE_FAILED':
+                cp_client.put_job_failure_result(
+                    jobId=job_id,
+                    failureDetails={
+                        'message': f'Stack Status: {stack_status}',
+                        'type': 'JobFailed'
+                    }
+                )
+
+            # Still Deleting - Continue
+            else:
+                cp_client.put_job_success_result(
+                    jobId=job_id,
+                    continuationToken=json.dumps(continuation_token)
+                )
+
+        if phase == 'WAITING':
             stack_id = continuation_token['stack_id']
             print(f'stack_id: {stack_id}')
 
             stack_name = continuation_token['stack_name']
             print(f'stack_name: {stack_name}')
 
+            # Tail the events of the operation since the last invocation
+            request_token = continuation_token.get('request_token')
+            event_id = continuation_token.get('event_id')
+            failure = None
+            if request_token is not None:
+                events = get_new_events(
+                    cfn_client, stack_id, request_token, event_id)
+                if events:
+                    event_id = events[-1]['EventId']
+                failure = get_first_failure(events, stack_id)
+                print(f'failure: {failure}')
+
             response = cfn_client.describe_stacks(StackName=stack_name)
             print('describe_stacks:')
             print(json.dumps(response, default=str))
@@ -87,35 +791,44 @@ def lambda_handler(event, context):
                     stack_status = stack['StackStatus']
 
                     # Succeeded - Done.
-                    if stack_status in [
-                            'CREATE_COMPLETE',
-                            'UPDATE_COMPLETE']:
+                    if stack_status in STACK_SUCCEEDED:
 
                         # Create Outputs here
-                        outputVariables = {}
-                        if ('Outputs' in stack):
-                            for output in stack['Outputs']:
-                                key = output['OutputKey']
-                                value = output['OutputValue']
-                                outputVariables[key] = value
-
                         cp_client.put_job_success_result(
                             jobId=job_id,
-                            outputVariables=outputVariables
+                            outputVariables=complete_stack(
+                                ssm_client, params, stack)
                         )
                     # Failed - Done.
-                    elif stack_status in [
-                            'UPDATE_ROLLBACK_COMPLETE',
-                            'ROLLBACK_COMPLETE',
-                            'CREATE_FAILED',
-                            'ROLLBACK_FAILED',
-                            'DELETE_FAILED',
-                            'UPDATE_ROLLBACK_FAILED']:
+                    elif stack_status in STACK_FAILED:
 
+                        message = f'Stack Status: {stack_status}'
+                        if failure is not None:
+                            message = f'{message}\n{failure}'
                         cp_client.put_job_failure_result(
                             jobId=job_id,
                             failureDetails={
-                                'message': f'Stack Status: {stack_status}',
+                                'message': message[:5000],
+                                'type': 'JobFailed'
+                            }
+                        )
+
+                    # Resource Failed - Done, without waiting for the
+                    # rollback. The update may be cancelled to start the
+                    # rollback right away. Failures of the cleanup of a
+                    # successful update started by an earlier poll are
+                    # ignored.
+                    elif failure is not None and \
+                            not is_cleaning_up(stack_status):
+                        if params.get('cancelOnFailure', False) and \
+                                stack_status == 'UPDATE_IN_PROGRESS':
+                            print('cancel_update_stack')
+                            cfn_client.cancel_update_stack(
+                                StackName=stack_id)
+                        cp_client.put_job_failure_result(
+                            jobId=job_id,
+                            failureDetails={
+                                'message': f'Stack Status: {stack_status}\n{failure}'[:5000],
                                 'type': 'JobFailed'
                             }
                         )
@@ -125,114 +838,75 @@ def lambda_handler(event, context):
                         cp_client.put_job_success_result(
                             jobId=job_id,
                             continuationToken=json.dumps({
+                                'phase': 'WAITING',
                                 'stack_id': stack_id,
-                                'stack_name': stack_name
+                                'stack_name': stack_name,
+                                'request_token': request_token,
+                                'event_id': event_id
                             })
                         )
 
-        else:
-            parameter_dict = {}
-            if 'parameterOverrides' in params:
-                for key in params['parameterOverrides']:
-                    parameter_dict[key] = params['parameterOverrides'][key]
-            if 'ssmParameterPath' in params:
-                ssm_params = json.loads(ssm_client.get_parameter(
-                    Name=params['ssmParameterPath']
-                )['Parameter']['Value'])
-
-                for key in ssm_params:
-                    if not key in parameter_dict:
-                        parameter_dict[key] = ssm_params[key]
-            parameters = []
-            for key in parameter_dict:
-                value = parameter_dict[key]
-                if isinstance(value, str):
-                    parameters.append(
-                        {
-                            'ParameterKey': key,
-                            'ParameterValue': value
-                        }
-                    )
-                elif isinstance(value, dict):
-                    parameters.append(
-                        {
-                            'ParameterKey': key,
-                            'ParameterValue': json.dumps(value)
-                        }
-                    )
-            print('parameters:')
-            print(json.dumps(parameters, default=str))
-
-            capabilities = []
-            if 'capabilities' in params:
-                capabilities.append(params['capabilities'])
-            print('capabilities:')
-            print(capabilities)
-
-            bucket_domain = params['bucketRegionalDomainName']
-            prefix = params['templatePrefix']
-            path = params['templatePath']
-            template_url = f'https://{bucket_domain}/{prefix}/{path}'
-            print(f'template_url: {template_url}')
+        elif phase == 'CREATING':
+            # Values resolved before the stack was deleted
+            ssm_params = continuation_token.get('ssm')
+            if ssm_params is None:
+                ssm_params = resolve_parameters(ssm_client, params)
 
             stack_name = params['stackName']
-
-            stack_exists = False
-            try:
-                # If the stack does not exist, an AmazonCloudFormationException
-                # is returned.
-                response = cfn_client.describe_stacks(StackName=stack_name)
-                print(json.dumps(response, default=str))
-                stack_exists = True
-
-                for stack in response['Stacks']:
-                    if (stack['StackName'] == stack_name):
-                        stack_status = stack['StackStatus']
-
-                        if stack_status == 'ROLLBACK_COMPLETE':
-                            response = cfn_client.delete_stack(
-                                StackName=stack_name
-                            )
-                            print('delete_stack response:')
-                            print(json.dumps(response, default=str))
-                            waiter = cfn_client.get_waiter(
-                                'stack_delete_complete')
-                            waiter.wait(StackName=stack_name, WaiterConfig={
-                                        'Delay': 30, 'MaxAttempts': 20})
-                            stack_exists = False
-                        break
-            except:
-                pass
-
-            if stack_exists:
-
-                print('Stack exists - updating stack')
-                response = cfn_client.update_stack(
-                    StackName=stack_name,
-                    TemplateURL=template_url,
-                    Parameters=parameters,
-                    Capabilities=capabilities
+            result, response = start_stack(
+                cfn_client,
+                boto3.client('s3'),
+                stack_name,
+                get_template_url(params),
+                get_parameters(params, ssm_params),
+                get_capabilities(params),
+                job_id)
+
+            # A stack in ROLLBACK_COMPLETE cannot be updated, delete it
+            # and create it again once deleted
+            if result == 'DELETING':
+                cp_client.put_job_success_result(
+                    jobId=job_id,
+                    continuationToken=dump_continuation_token({
+                        'phase': 'DELETING',
+                        'stack_id': response['StackId'],
+                        'stack_name': stack_name
+                    }, ssm_params)
                 )
-            else:
-                print('Stack does not exists - creating stack')
-                response = cfn_client.create_stack(
-                    StackName=stack_name,
-                    TemplateURL=template_url,
-                    Parameters=parameters,
-                    Capabilities=capabilities
+                return
+
+            # Unchanged template, parameters and capabilities - Done.
+            if result == 'UNCHANGED':
+                cp_client.put_job_success_result(
+                    jobId=job_id,
+                    outputVariables=complete_stack(
+                        ssm_client, params, response)
                 )
-                print(json.dumps(response, default='str'))
+                return
 
             stack_id = response['StackId']
             print(f'stack_id: {stack_id}')
 
-            cp_client.put_job_success_result(
-                jobId=job_id,
-                continuationToken=json.dumps({
-                    'stack_id': stack_id,
-                    'stack_name': stack_name
-                })
-            )
+            # The job is completed by complete_stack_jobs once the stack
+            # status change event is received. Events are only received
+            # from the account and region of the pipeline, other stacks
+            # are polled.
+            if params.get('completionMode') == 'event' and \
+                    current_account_id == account_id and \
+                    region == os.environ['AWS_REGION']:
+                print('Waiting for the stack status change event')
+
+            else:
+                cp_client.put_job_success_result(
+                    jobId=job_id,
+                    continuationToken=json.dumps({
+                        'phase': 'WAITING',
+                        'stack_id': stack_id,
+                        'stack_name': stack_name,
+                        'request_token': job_id,
+                        'event_id': None
+                    })
+                )
 
     except Exception as e:
         # If any other exceptions which we didn't expect are raised
@@ -241,7 +915,9 @@ def lambda_handler(event, context):
         print(e)
         cp_client.put_job_failure_result(
             jobId=job_id, failureDetails={
-                'message': e,
+                # The failure message is a string of at most 5000
+                # characters
+                'message': str(e)[:5000],
                 'type': 'JobFailed'
             }
         )
@@ -0,0 +1,136 @@
+######################################################################################################################
+#  Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.                                           #
+#                                                                                                                    #
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance    #
+#  with the License. A copy of the License is located at                                                             #
+#                                                                                                                    #
+#      http://www.apache.org/licenses/LICENSE-2.0                                                                    #
+#                                                                                                                    #
+#  or in the 'license' file accompanying this file. This file is distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES #
+#  OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions    #
+#  and limitations under the License.                                                                                #
+######################################################################################################################
+
+import json
+
+from urllib.parse import urlparse
+
+from botocore.exceptions import ClientError
+
+# Objects recording the validation of the templates of a repository by ETag,
+# see validate_template. They are kept outside of the repository prefix,
+# whose objects are replaced or deleted when the repository is published.
+VALIDATION_INDEX_PREFIX = '.validation-index'
+
+# Validation errors describing the template itself, which are cached. Others,
+# failing to fetch the template for instance, depend on the caller and are
+# raised uncached.
+TEMPLATE_ERROR_PREFIXES = (
+    'Template format error',
+    'Template error',
+    'Invalid template'
+)
+
+
+def get_template_location(template_url):
+    url = urlparse(template_url)
+    return url.netloc.split('.s3')[0], url.path.lstrip('/')
+
+
+def head_template(s3_client, template_url):
+    bucket_name, key = get_template_location(template_url)
+    return s3_client.head_object(Bucket=bucket_name, Key=key)
+
+
+def load_index(s3_client, bucket_name, prefix):
+    try:
+        response = s3_client.get_object(
+            Bucket=bucket_name, Key=f'{VALIDATION_INDEX_PREFIX}/{prefix}.json')
+        return json.loads(response['Body'].read())
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ['404', 'NoSuchKey']:
+            raise
+        return {}
+
+
+def save_index(s3_client, bucket_name, prefix, index, kms_key_id):
+    args = {
+        'Bucket': bucket_name,
+        'Key': f'{VALIDATION_INDEX_PREFIX}/{prefix}.json',
+        'Body': json.dumps(index).encode('utf-8'),
+        'ServerSideEncryption': 'aws:kms'
+    }
+    if kms_key_id is not None:
+        args['SSEKMSKeyId'] = kms_key_id
+    s3_client.put_object(**args)
+
+
+def validate_template(cfn_client, s3_client, template_url, etag, kms_key_id):
+    """ Validates a template, once per ETag
+
+    The result of validate_template is recorded in the index object of the
+    repository of the template: the template error, or the capabilities and
+    parameters (with whether they have a default) of the template. A
+    template whose ETag is in the index is not validated again. Concurrent
+    actions may overwrite each other's entries, which are then validated
+    again.
+    """
+    bucket_name, key = get_template_location(template_url)
+    prefix, _, path = key.partition('/')
+
+    index = load_index(s3_client, bucket_name, prefix)
+    result = index.get(path)
+    if result is not None and result['etag'] == etag:
+        print(f'{path} validated for {etag}')
+        return result
+
+    try:
+        response = cfn_client.validate_template(TemplateURL=template_url)
+        result = {
+            'etag': etag,
+            'error': None,
+            'capabilities': response.get('Capabilities', []),
+            'parameters': {
+                parameter['ParameterKey']: 'DefaultValue' in parameter
+                for parameter in response.get('Parameters', [])
+            }
+        }
+    except ClientError as e:
+        message = e.response['Error']['Message']
+        if e.response['Error']['Code'] != 'ValidationError' or \
+                not message.startswith(TEMPLATE_ERROR_PREFIXES):
+            raise
+        result = {'etag': etag, 'error': message}
+
+    index[path] = result
+    save_index(s3_client, bucket_name, prefix, index, kms_key_id)
+    return result
+
+
+def check_template(result, parameters, capabilities):
+    """Raises a ValueError describing why the template cannot be deployed with the parameters and capabilities."""
+    if result['error'] is not None:
+        raise ValueError(f'Template validation failed: {result["error"]}')
+
+    # Named IAM resources require the named IAM capability, which covers
+    # the other IAM resources as well
+    granted = set(capabilities)
+    if 'CAPABILITY_NAMED_IAM' in granted:
+        granted.add('CAPABILITY_IAM')
+    missing = set(result['capabilities']) - granted
+    if missing:
+        raise ValueError(
+            f'Template requires the capabilities {sorted(missing)}')
+
+    keys = {parameter['ParameterKey'] for parameter in parameters}
+    unknown = keys - set(result['parameters'])
+    if unknown:
+        raise ValueError(
+            f'Parameters {sorted(unknown)} do not exist in the template')
+    required = {
+        key for key, has_default in result['parameters'].items()
+        if not has_default
+    } - keys
+    if required:
+        raise ValueError(
+            f'Parameters {sorted(required)} must have values')
@@ -13,19 +13,515 @@
 
 
 import boto3
+import hashlib
+import io
 import json
 import mimetypes
+import threading
+import time
+import uuid
 
 import zipfile
-import tempfile
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from boto3.s3.transfer import TransferConfig
 from boto3.session import Session
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from snapshot_archive import get_member_index, materialize_nested_templates, save_index, SNAPSHOT_ARCHIVE_FILE_NAME
+
+# Time kept in reserve at the end of an invocation to checkpoint the progress
+# into a continuation token
+TIME_RESERVE_SECONDS = 30
+
+# Maximum length of a CodePipeline continuation token. Longer tokens are
+# stored in the bucket and referenced from the token.
+CONTINUATION_TOKEN_MAX_LENGTH = 2048
+
+# Records the CRC32 and size of every member expanded under a repository
+# prefix
+MANIFEST_FILE_NAME = '.manifest.json'
+
+# Marker recording, in its metadata, the source last expanded under a
+# repository prefix and a digest of its members
+LEDGER_FILE_NAME = '.expansion-ledger'
+
+# Maximum number of keys accepted by a single delete_objects call
+DELETE_BATCH_SIZE = 1000
+
+# Size of the blocks read ahead from the input artifact and number of blocks
+# kept in cache
+READ_AHEAD_SIZE = 1024 * 1024
+READ_AHEAD_BLOCKS = 4
+
+
+# Number of members uploaded in parallel
+DEFAULT_CONCURRENCY = 8
+
+# Size of the parts of the multipart uploads of the members and number of
+# parts of a member uploaded in parallel, or buffered. Peak memory is
+# bounded by their product times the number of members uploaded in
+# parallel (256 MB by default) instead of by the largest member.
+DEFAULT_PART_SIZE_MB = 8
+PART_CONCURRENCY = 4
+
+# S3 clients are re-used by warm invocations, their connection pools are
+# sized to the number of parts uploaded in parallel
+s3_clients = {}
+
+# Number of retried S3 requests, see count_retries
+retries = {'count': 0}
+retries_lock = threading.Lock()
+
+
+class S3RangeFile(io.RawIOBase):
+    """ Read only, seekable file object over an S3 object
+
+    Reads are served by range requests so that zipfile can open an artifact
+    without downloading it: only the central directory and the members being
+    read are fetched. Small reads are served from cached blocks read ahead
+    of the position, reads larger than a block are fetched directly.
+    """
+
+    def __init__(self, s3_client, bucket_name, key):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.key = key
+        self.size = s3_client.head_object(
+            Bucket=bucket_name, Key=key)['ContentLength']
+        self.position = 0
+        self.blocks = OrderedDict()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError(f'Negative seek position {offset}')
+        self.position = offset
+        return self.position
+
+    def get_range(self, first, last):
+        return self.s3_client.get_object(
+            Bucket=self.bucket_name,
+            Key=self.key,
+            Range=f'bytes={first}-{last}')['Body'].read()
+
+    def get_block(self, index):
+        if index in self.blocks:
+            self.blocks.move_to_end(index)
+        else:
+            first = index * READ_AHEAD_SIZE
+            last = min(first + READ_AHEAD_SIZE, self.size) - 1
+            self.blocks[index] = self.get_range(first, last)
+            if len(self.blocks) > READ_AHEAD_BLOCKS:
+                self.blocks.popitem(last=False)
+        return self.blocks[index]
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.size - self.position)
+        if size <= 0:
+            return 0
+
+        view = memoryview(buffer)
+        if size >= READ_AHEAD_SIZE:
+            data = self.get_range(self.position, self.position + size - 1)
+            view[:size] = data
+            self.position += size
+            return size
+
+        read = 0
+        while read < size:
+            index, offset = divmod(self.position, READ_AHEAD_SIZE)
+            chunk = self.get_block(index)[offset:offset + size - read]
+            view[read:read + len(chunk)] = chunk
+            read += len(chunk)
+            self.position += len(chunk)
+        return read
+
+
+def count_retries(parsed, **kwargs):
+    attempts = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+    if attempts:
+        with retries_lock:
+            retries['count'] += attempts
+
+
+def get_s3_client(concurrency):
+    if concurrency not in s3_clients:
+        s3_client = boto3.client(
+            's3',
+            config=Config(max_pool_connections=concurrency * PART_CONCURRENCY))
+        s3_client.meta.events.register('after-call.s3', count_retries)
+        s3_clients[concurrency] = s3_client
+    return s3_clients[concurrency]
+
+
+class StreamReader(io.RawIOBase):
+    """ Read only, non seekable view of a file object
+
+    s3transfer sizes seekable files by seeking to their end, which a zip
+    member does by reading, and decompressing, all of it. Members are
+    streamed once through this view instead.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.fileobj.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def upload_member(s3_client, zip, lock, member, bucket_name, key, extra_args, transfer_config):
+    """ Streams a member of the artifact into the bucket
+
+    Returns the size of the member.
+    """
+    # Opening a member is not thread safe, reading it is
+    with lock:
+        content = zip.open(member)
+    with content:
+        s3_client.upload_fileobj(
+            StreamReader(content),
+            bucket_name,
+            key,
+            ExtraArgs=extra_args,
+            Config=transfer_config)
+    return member.file_size
+
+
+def collect_uploads(futures, manifest, stats, block):
+    """ Records the completed uploads in the manifest and the stats
+
+    Waits for every upload when block is set, for at least one otherwise.
+    """
+    done, _ = wait(futures, return_when='ALL_COMPLETED' if block else 'FIRST_COMPLETED')
+    for future in done:
+        member = futures.pop(future)
+        stats['bytes'] += future.result()
+        stats['uploaded'] += 1
+        manifest[member.filename] = get_fingerprint(member)
+
+
+def get_source_version(s3_client, artifact):
+    """ Identifies the source of an input artifact
+
+    This is the revision of the artifact (commit id or S3 object version)
+    when CodePipeline provides one, the ETag of the artifact otherwise.
+    """
+    if artifact.get('revision'):
+        return artifact['revision']
+    location = artifact['location']['s3Location']
+    return s3_client.head_object(
+        Bucket=location['bucketName'],
+        Key=location['objectKey'])['ETag']
+
+
+def get_ledger(s3_client, bucket_name, repository_name):
+    """ Reads the expansion ledger of a repository prefix with a single HEAD
+    request, None if the prefix has no complete expansion
+    """
+    try:
+        response = s3_client.head_object(
+            Bucket=bucket_name,
+            Key=f'{repository_name}/{LEDGER_FILE_NAME}')
+    except ClientError as e:
+        if e.response['Error']['Code'] in ['404', 'NoSuchKey', 'NotFound']:
+            return None
+        raise
+    return response['Metadata']
+
+
+def save_ledger(s3_client, bucket_name, repository_name, ledger, kms_key_id):
+    s3_client.put_object(
+        Bucket=bucket_name,
+        Key=f'{repository_name}/{LEDGER_FILE_NAME}',
+        Body=b'',
+        Metadata=ledger,
+        ServerSideEncryption='aws:kms',
+        SSEKMSKeyId=kms_key_id)
+
+
+def get_members_digest(members):
+    """ Digest of the paths and fingerprints of a member set
+    """
+    digest = hashlib.sha256()
+    for path in sorted(members):
+        digest.update(f'{path}:{members[path]}\n'.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def get_fingerprint(member):
+    return f'{member.CRC:08x}:{member.file_size}'
+
+
+def load_manifest(s3_client, bucket_name, repository_name):
+    """ Loads the path->fingerprint dictionary of the expanded members
+    """
+    try:
+        response = s3_client.get_object(
+            Bucket=bucket_name,
+            Key=f'{repository_name}/{MANIFEST_FILE_NAME}')
+    except s3_client.exceptions.NoSuchKey:
+        return {}
+    return json.loads(response['Body'].read())['members']
+
+
+def save_manifest(s3_client, bucket_name, repository_name, members, kms_key_id):
+    s3_client.put_object(
+        Bucket=bucket_name,
+        Key=f'{repository_name}/{MANIFEST_FILE_NAME}',
+        Body=json.dumps({'members': members}),
+        ContentType='application/json',
+        ServerSideEncryption='aws:kms',
+        SSEKMSKeyId=kms_key_id)
+
+
+def load_continuation_token(s3_client, bucket_name, continuation_token):
+    token = json.loads(continuation_token)
+    if 'checkpointKey' in token:
+        key = token['checkpointKey']
+        token = json.loads(s3_client.get_object(
+            Bucket=bucket_name, Key=key)['Body'].read())
+        s3_client.delete_object(Bucket=bucket_name, Key=key)
+    return token
+
+
+def save_continuation_token(s3_client, bucket_name, token, kms_key_id):
+    """ Serializes the continuation token, storing it in the bucket when it
+    is too long for CodePipeline
+    """
+    continuation_token = json.dumps(token)
+    if len(continuation_token) > CONTINUATION_TOKEN_MAX_LENGTH:
+        key = f'.checkpoints/{uuid.uuid4()}.json'
+        s3_client.put_object(
+            Bucket=bucket_name,
+            Key=key,
+            Body=continuation_token,
+            ContentType='application/json',
+            ServerSideEncryption='aws:kms',
+            SSEKMSKeyId=kms_key_id)
+        continuation_token = json.dumps({'checkpointKey': key})
+    return continuation_token
+
+
+def list_keys(s3_client, bucket_name, prefix):
+    paginator = s3_client.get_paginator('list_objects_v2')
+    keys = set()
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        keys.update(item['Key'] for item in page.get('Contents', []))
+    return keys
+
+
+def delete_keys(s3_client, bucket_name, keys):
+    """ Deletes the keys using the batch API, 1000 keys per call
+    """
+    for i in range(0, len(keys), DELETE_BATCH_SIZE):
+        response = s3_client.delete_objects(
+            Bucket=bucket_name,
+            Delete={
+                'Objects': [{'Key': key} for key in keys[i:i + DELETE_BATCH_SIZE]],
+                'Quiet': True
+            })
+        if response.get('Errors'):
+            raise Exception(f'Failed to delete objects: {response["Errors"]}')
+
+
+def expand_artifact(s3_client, executor, artifact, repository_name, params, checkpoint, deadline):
+    """ Expands an input artifact under its repository prefix
+
+    An expansion still running at the deadline is interrupted once its in
+    flight uploads complete. The returned checkpoint (the number of members
+    already considered and the source being expanded) resumes it, it is
+    None once the expansion is complete.
+    """
+    start = time.time()
+    start_retries = retries['count']
+
+    bucket_name = artifact['location']['s3Location']['bucketName']
+    object_key = artifact['location']['s3Location']['objectKey']
+    print(f'{repository_name} bucket_name {bucket_name} object_key {object_key}')
+
+    publish_mode = params.get('publishMode', 'files')
+
+    stats = {
+        'repositoryName': repository_name,
+        'members': 0,
+        'uploaded': 0,
+        'bytes': 0
+    }
+
+    if checkpoint is None:
+        # Skip the sources already expanded under the prefix, unless a
+        # refresh is forced
+        source_version = get_source_version(s3_client, artifact)
+        print(f'{repository_name} source_version {source_version}')
+        ledger = get_ledger(s3_client, params['bucketName'], repository_name)
+        if (ledger is not None and
+                ledger.get('source') == source_version and
+                ledger.get('mode') == publish_mode and
+                not params.get('forceRefresh', False)):
+            print(f'{repository_name} is already expanded from {source_version}')
+            stats['skipped'] = True
+            return stats, None
+
+        # The prefix matches no source until the expansion completes
+        s3_client.delete_object(
+            Bucket=params['bucketName'],
+            Key=f'{repository_name}/{LEDGER_FILE_NAME}')
+        cursor = 0
+    else:
+        source_version = checkpoint['source']
+        cursor = checkpoint['cursor']
+        print(f'{repository_name} resuming at member {cursor}')
+
+    # A snapshot archive is the input artifact itself, copied server side
+    if publish_mode == 'archive':
+        delete_keys(s3_client, params['bucketName'], sorted(list_keys(
+            s3_client, params['bucketName'], f'{repository_name}/')))
+        s3_client.copy_object(
+            Bucket=params['bucketName'],
+            Key=f'{repository_name}/{SNAPSHOT_ARCHIVE_FILE_NAME}',
+            CopySource={'Bucket': bucket_name, 'Key': object_key},
+            ContentType='application/zip',
+            MetadataDirective='REPLACE',
+            ServerSideEncryption='aws:kms',
+            SSEKMSKeyId=params['kmsKeyId'])
+
+        members = get_member_index(
+            S3RangeFile(s3_client, bucket_name, object_key))
+
+        index = save_index(s3_client, params['bucketName'], repository_name,
+                           members, params['kmsKeyId'], {'objectKey': object_key})
+        stats['extracted'] = materialize_nested_templates(
+            s3_client, params['bucketName'], repository_name, index)
+        save_ledger(s3_client, params['bucketName'], repository_name, {
+            'source': source_version,
+            'mode': publish_mode,
+            'digest': get_members_digest({
+                path: f'{member["crc"]:08x}:{member["size"]}'
+                for path, member in members.items()
+            })
+        }, params['kmsKeyId'])
+        stats['members'] = len(members)
+        stats['seconds'] = round(time.time() - start, 3)
+        return stats, None
+
+    # The manifest records what is in the bucket, so only the members
+    # whose CRC32 or size differ from it, or whose object is missing, are
+    # uploaded.
+    manifest = load_manifest(s3_client, params['bucketName'], repository_name)
+    existing_keys = list_keys(
+        s3_client, params['bucketName'], f'{repository_name}/')
+
+    # Members are streamed from the artifact into multipart uploads
+    part_size = int(params.get('partSizeMb', DEFAULT_PART_SIZE_MB)) * 1024 * 1024
+    transfer_config = TransferConfig(
+        multipart_threshold=part_size,
+        multipart_chunksize=part_size,
+        max_concurrency=PART_CONCURRENCY,
+        max_in_memory_upload_chunks=PART_CONCURRENCY)
+
+    # The artifact is read in place, without a copy in /tmp. Members are
+    # uploaded in parallel, smallest first so that template heavy
+    # artifacts complete quickly.
+    lock = threading.Lock()
+    with zipfile.ZipFile(S3RangeFile(s3_client, bucket_name, object_key)) as zip:
+        members = sorted(
+            [member for member in zip.infolist() if member.file_size],
+            key=lambda member: (member.file_size, member.filename))
+
+        futures = {}
+        while cursor < len(members) and time.time() < deadline:
+            member = members[cursor]
+            key = f'{repository_name}/{member.filename}'
+            fingerprint = get_fingerprint(member)
+            if manifest.get(member.filename) != fingerprint or key not in existing_keys:
+                extra_args = {
+                    'Metadata': {
+                        'crc32': f'{member.CRC:08x}',
+                        'size': str(member.file_size)
+                    },
+                    'ServerSideEncryption': 'aws:kms',
+                    'SSEKMSKeyId': params['kmsKeyId']
+                }
+                # we have to guess the mime content-type of the files and
+                # provide it to S3 since S3 cannot do this on its own.
+                content_type = mimetypes.guess_type(member.filename)[0]
+                if content_type is not None:
+                    extra_args['ContentType'] = content_type
+
+                futures[executor.submit(
+                    upload_member, s3_client, zip, lock, member,
+                    params['bucketName'], key, extra_args,
+                    transfer_config)] = member
+            cursor += 1
+
+            # Bound the number of queued members
+            if len(futures) >= 2 * int(params.get('concurrency', DEFAULT_CONCURRENCY)):
+                collect_uploads(futures, manifest, stats, False)
+
+        collect_uploads(futures, manifest, stats, True)
+
+    stats['members'] = len(members)
+    stats['retries'] = retries['count'] - start_retries
+
+    if cursor < len(members):
+        if stats['uploaded']:
+            save_manifest(s3_client, params['bucketName'],
+                          repository_name, manifest, params['kmsKeyId'])
+        stats['seconds'] = round(time.time() - start, 3)
+        stats['complete'] = False
+        return stats, {'cursor': cursor, 'source': source_version}
+
+    # Remove the objects of the members no longer in the artifact
+    paths = set(member.filename for member in members)
+    deleted_keys = sorted(
+        key for key in existing_keys
+        if key[len(repository_name) + 1:] not in paths and
+        key != f'{repository_name}/{MANIFEST_FILE_NAME}' and
+        key != f'{repository_name}/{LEDGER_FILE_NAME}')
+    delete_keys(s3_client, params['bucketName'], deleted_keys)
+    for path in list(manifest):
+        if path not in paths:
+            del manifest[path]
+    stats['deleted'] = len(deleted_keys)
+
+    if stats['uploaded'] or deleted_keys:
+        save_manifest(s3_client, params['bucketName'],
+                      repository_name, manifest, params['kmsKeyId'])
+    save_ledger(s3_client, params['bucketName'], repository_name, {
+        'source': source_version,
+        'mode': publish_mode,
+        'digest': get_members_digest(manifest)
+    }, params['kmsKeyId'])
+
+    stats['seconds'] = round(time.time() - start, 3)
+    stats['complete'] = True
+    return stats, None
 
 
 def lambda_handler(event, context):
 
     cp_client = boto3.client('codepipeline')
-    s3_client = boto3.client('s3')
 
     try:
         print(json.dumps(event))
@@ -40,45 +536,79 @@ def lambda_handler(event, context):
             job_data['actionConfiguration']['configuration']['UserParameters'])
         print(json.dumps(params))
 
-        tmp_file = tempfile.NamedTemporaryFile()
-        bucket_name = job_data['inputArtifacts'][0]['location']['s3Location']['bucketName']
-        object_key = job_data['inputArtifacts'][0]['location']['s3Location']['objectKey']
-
-        print(f'bucket_name {bucket_name}')
-
-        print(f'object_key {object_key}')
-
-        repository_name = params['repositoryName']
-
-        bucket = boto3.resource('s3').Bucket(params['bucketName'])
-        bucket.objects.filter(Prefix=f'{repository_name}/').delete()
-        branch_name = params['branchName']
-
-        with tempfile.NamedTemporaryFile() as tmp_file:
-            s3_client.download_file(bucket_name, object_key, tmp_file.name)
-
-            with zipfile.ZipFile(tmp_file.name) as zip:
-                for path in zip.namelist():
-                    content = zip.read(path)
-                    if(len(content)):
-                        # we have to guess the mime content-type of the files and
-                        # provide it to S3 since S3 cannot do this on its own.
-                        content_type = mimetypes.guess_type(path)[0]
-                        if content_type is not None:
-                            bucket.put_object(
-                                Body=(content),
-                                Key=f'{repository_name}/{path}',
-                                ContentType=content_type,
-                                ServerSideEncryption='aws:kms',
-                                SSEKMSKeyId=params['kmsKeyId'])
-                        else:
-                            bucket.put_object(
-                                Body=(content),
-                                Key=f'{repository_name}/{path}',
-                                ServerSideEncryption='aws:kms',
-                                SSEKMSKeyId=params['kmsKeyId'])
-
-        cp_client.put_job_success_result(jobId=job_id)
+        concurrency = int(params.get('concurrency', DEFAULT_CONCURRENCY))
+        s3_client = get_s3_client(concurrency)
+
+        # Stop expanding when the remaining time is needed to checkpoint the
+        # progress
+        deadline = time.time() + \
+            context.get_remaining_time_in_millis() / 1000 - TIME_RESERVE_SECONDS
+
+        # Input artifacts are mapped to repository prefixes by name. A single
+        # input artifact may be given its repository name instead.
+        artifacts = {}
+        for artifact in job_data['inputArtifacts']:
+            if 'repositories' in params:
+                artifacts[artifact['name']] = (
+                    artifact, params['repositories'][artifact['name']])
+            else:
+                artifacts[artifact['name']] = (
+                    artifact, params['repositoryName'])
+
+        # The continuation token holds a checkpoint for each artifact still
+        # to expand
+        if 'continuationToken' in job_data:
+            token = load_continuation_token(
+                s3_client, params['bucketName'], job_data['continuationToken'])
+            checkpoints = token['checkpoints']
+            failures = token['failures']
+        else:
+            checkpoints = {name: None for name in artifacts}
+            failures = []
+
+        # Artifacts are expanded concurrently, their members are uploaded by
+        # a single pool
+        with ThreadPoolExecutor(max_workers=concurrency) as executor, \
+                ThreadPoolExecutor(max_workers=len(checkpoints)) as artifact_executor:
+            futures = {
+                name: artifact_executor.submit(
+                    expand_artifact, s3_client, executor, artifacts[name][0],
+                    artifacts[name][1], params, checkpoint, deadline)
+                for name, checkpoint in checkpoints.items()
+            }
+
+            # A failed artifact does not abort its siblings
+            next_checkpoints = {}
+            for name, future in futures.items():
+                try:
+                    stats, checkpoint = future.result()
+                    print(json.dumps(stats))
+                    if checkpoint is not None:
+                        next_checkpoints[name] = checkpoint
+                except Exception as e:
+                    print(f'{name} failed: {e}')
+                    failures.append(f'{name}: {e}')
+
+        if next_checkpoints:
+            print(f'next_checkpoints: {json.dumps(next_checkpoints)}')
+            cp_client.put_job_success_result(
+                jobId=job_id,
+                continuationToken=save_continuation_token(
+                    s3_client, params['bucketName'], {
+                        'checkpoints': next_checkpoints,
+                        'failures': failures
+                    }, params['kmsKeyId'])
+            )
+        elif failures:
+            cp_client.put_job_failure_result(
+                jobId=job_id, failureDetails={
+                    # The failure message is limited to 5000 characters
+                    'message': '\n'.join(failures)[:5000],
+                    'type': 'JobFailed'
+                }
+            )
+        else:
+            cp_client.put_job_success_result(jobId=job_id)
 
     except Exception as e:
         # If any other exceptions which we didn't expect are raised
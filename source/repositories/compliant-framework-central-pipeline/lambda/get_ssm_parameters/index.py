@@ -17,15 +17,7 @@ import json
 import boto3
 from botocore.exceptions import ClientError
 
-
-def ssm_get_parameter(name):
-    """ Gets an SSM Parameter
-    """
-    ssm_client = boto3.client('ssm')
-    response = ssm_client.get_parameter(
-        Name=name
-    )
-    return response['Parameter']['Value']
+from parameter_resolver import get_parameters
 
 
 def lambda_handler(event, context):
@@ -47,10 +39,11 @@ def lambda_handler(event, context):
 
         outputVariables = {}
 
-        # print(params['Name'])
+        # Parameters are fetched in batches and cached by warm invocations
+        values = get_parameters(
+            boto3.client('ssm'), [item['Name'] for item in params['Items']])
         for item in params['Items']:
-            value = ssm_get_parameter(item['Name'])
-            outputVariables[item['OutputVariable']] = value
+            outputVariables[item['OutputVariable']] = values[item['Name']]
 
         print(json.dumps(outputVariables))
 
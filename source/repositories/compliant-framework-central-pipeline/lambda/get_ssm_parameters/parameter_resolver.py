@@ -0,0 +1,104 @@
+######################################################################################################################
+#  Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.                                           #
+#                                                                                                                    #
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance    #
+#  with the License. A copy of the License is located at                                                             #
+#                                                                                                                    #
+#      http://www.apache.org/licenses/LICENSE-2.0                                                                    #
+#                                                                                                                    #
+#  or in the 'license' file accompanying this file. This file is distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES #
+#  OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions    #
+#  and limitations under the License.                                                                                #
+######################################################################################################################
+
+import json
+import threading
+import time
+
+# Time resolved values are re-used by warm invocations
+CACHE_TTL_SECONDS = 300
+
+# Maximum number of names accepted by a single get_parameters call
+GET_PARAMETERS_BATCH_SIZE = 10
+
+# Resolved values by parameter name or path, with their expiry time
+cache = {}
+cache_lock = threading.Lock()
+
+
+def get_cached(key):
+    with cache_lock:
+        entry = cache.get(key)
+    if entry is not None and entry[0] > time.time():
+        return entry[1]
+    return None
+
+
+def set_cached(key, value):
+    with cache_lock:
+        cache[key] = (time.time() + CACHE_TTL_SECONDS, value)
+
+
+def get_parameters(ssm_client, names):
+    """ Values of SSM parameters by name
+
+    Names missing from the cache are fetched GET_PARAMETERS_BATCH_SIZE at a
+    time. Raises a KeyError naming the parameters which do not exist.
+    """
+    values = {}
+    missing = []
+    for name in dict.fromkeys(names):
+        value = get_cached(('name', name))
+        if value is None:
+            missing.append(name)
+        else:
+            values[name] = value
+
+    for index in range(0, len(missing), GET_PARAMETERS_BATCH_SIZE):
+        response = ssm_client.get_parameters(
+            Names=missing[index:index + GET_PARAMETERS_BATCH_SIZE])
+        if response['InvalidParameters']:
+            raise KeyError(
+                f'SSM parameters not found: {response["InvalidParameters"]}')
+        for parameter in response['Parameters']:
+            set_cached(('name', parameter['Name']), parameter['Value'])
+            values[parameter['Name']] = parameter['Value']
+
+    return values
+
+
+def get_parameters_by_path(ssm_client, path):
+    """Values of the SSM parameters under a path hierarchy, by their last name segment."""
+    values = get_cached(('path', path))
+    if values is None:
+        values = {}
+        paginator = ssm_client.get_paginator('get_parameters_by_path')
+        for page in paginator.paginate(Path=path, Recursive=True):
+            for parameter in page['Parameters']:
+                values[parameter['Name'].split('/')[-1]] = parameter['Value']
+        set_cached(('path', path), values)
+    return values
+
+
+def resolve_parameters(ssm_client, params):
+    """ Stack parameter values held in SSM
+
+    Merges, each taking precedence over the previous one:
+        ssmParameterPath : A parameter holding a JSON object of values.
+        ssmParameterHierarchy : A path whose parameters are named after the
+          stack parameters.
+        ssmParameters : A map of stack parameter to SSM parameter name.
+    """
+    values = {}
+    if 'ssmParameterPath' in params:
+        name = params['ssmParameterPath']
+        values.update(json.loads(get_parameters(ssm_client, [name])[name]))
+    if 'ssmParameterHierarchy' in params:
+        values.update(get_parameters_by_path(
+            ssm_client, params['ssmParameterHierarchy']))
+    if 'ssmParameters' in params:
+        resolved = get_parameters(
+            ssm_client, params['ssmParameters'].values())
+        for key, name in params['ssmParameters'].items():
+            values[key] = resolved[name]
+    return values
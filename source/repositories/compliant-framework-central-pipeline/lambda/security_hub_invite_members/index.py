@@ -14,6 +14,11 @@
 import boto3
 import json
 
+from session_broker import SessionBroker
+
+# Assumed-role sessions, re-used by warm invocations
+broker = SessionBroker()
+
 
 def lambda_handler(event, context):
     # pylint: disable=E1101
@@ -37,7 +42,6 @@ def lambda_handler(event, context):
         region = params['region']
 
         sh_client = boto3.client('securityhub', region_name=region)
-        sts_client = boto3.client('sts')
 
         # Create list of accounts to invite
         accounts_to_invite = list()
@@ -76,23 +80,10 @@ def lambda_handler(event, context):
 
                 print(f'Need to accept invite for {account_id}')
 
-                # Assume Role
-                partition = params['partition']
-                role_arn = f'arn:{partition}:iam::{account_id}:'\
-                    f'role/SecurityHubAccessRole'
-                assumed_role = sts_client.assume_role(
-                    RoleArn=role_arn,
-                    RoleSessionName='CompliantFramework'
-                )
-
                 # Member Client
-                member_sh_client = boto3.client(
-                    'securityhub',
-                    aws_access_key_id=assumed_role['Credentials']['AccessKeyId'],
-                    aws_secret_access_key=assumed_role['Credentials']['SecretAccessKey'],
-                    aws_session_token=assumed_role['Credentials']['SessionToken'],
-                    region_name=region
-                )
+                member_sh_client = broker.client(
+                    'securityhub', params['partition'], account_id,
+                    role_name='SecurityHubAccessRole', region=region)
 
                 # Look for the invitation to accept
                 invitations_list = member_sh_client.list_invitations()
@@ -15,6 +15,9 @@ import boto3
 import json
 import mimetypes
 
+from parameter_resolver import resolve_parameters
+from snapshot_archive import materialize_template
+
 
 def stack_set_exists(cf_client, stack_name):
     try:
@@ -49,7 +52,7 @@ def get_ou_id(org_client, ou_name):
     return None
 
 
-def create_update_stackset(cf_client, stack_name, template_url, parameters, capabilities, tags, organization_unit_id, region):
+def create_update_stackset(cf_client, stack_name, template_url, parameters, capabilities, tags, organization_unit_id, region, operation_id):
     if not stack_set_exists(cf_client, stack_name):
         cf_client.create_stack_set(
             StackSetName=stack_name,
@@ -69,7 +72,8 @@ def create_update_stackset(cf_client, stack_name, template_url, parameters, capa
             DeploymentTargets={
                 'OrganizationalUnitIds': [organization_unit_id]
             },
-            Regions=[region]
+            Regions=[region],
+            OperationId=operation_id
         )
 
         operation_id = response['OperationId']
@@ -85,7 +89,8 @@ def create_update_stackset(cf_client, stack_name, template_url, parameters, capa
             AutoDeployment={
                 'Enabled': True,
                 'RetainStacksOnAccountRemoval': True
-            }
+            },
+            OperationId=operation_id
         )
 
         operation_id = response['OperationId']
@@ -176,14 +181,10 @@ def lambda_handler(event, context):
                 for key in params['parameters']:
                     parameter_dict[key] = params['parameters'][key]
 
-            if 'ssmParameterPath' in params:
-                ssm_params = json.loads(ssm_client.get_parameter(
-                    Name=params['ssmParameterPath']
-                )['Parameter']['Value'])
-
-                for key in ssm_params:
-                    if not key in parameter_dict:
-                        parameter_dict[key] = ssm_params[key]
+            ssm_params = resolve_parameters(ssm_client, params)
+            for key in ssm_params:
+                if not key in parameter_dict:
+                    parameter_dict[key] = ssm_params[key]
 
             stack_set_parameters = []
             for key in parameter_dict:
@@ -195,6 +196,10 @@ def lambda_handler(event, context):
                     }
                 )
 
+            # Extract the template if its repository is published as a
+            # snapshot archive
+            materialize_template(boto3.client('s3'), params['templateUrl'])
+
             operation_id = create_update_stackset(
                 cf_client,
                 params['stackSetName'],
@@ -203,14 +208,22 @@ def lambda_handler(event, context):
                 params['capabilities'],
                 params['tags'],
                 ou_id,
-                params['region']
+                params['region'],
+                # Correlates the operation status change event with the job
+                job_id
             )
             print(f'operation_id: {operation_id}')
 
-            cp_client.put_job_success_result(
-                jobId=job_id,
-                continuationToken=json.dumps({'operationId': operation_id})
-            )
+            # The job is completed by complete_stack_jobs once the operation
+            # status change event is received
+            if params.get('completionMode') == 'event':
+                print('Waiting for the operation status change event')
+
+            else:
+                cp_client.put_job_success_result(
+                    jobId=job_id,
+                    continuationToken=json.dumps({'operationId': operation_id})
+                )
 
     except Exception as e:
         # If any other exceptions which we didn't expect are raised
@@ -14,11 +14,262 @@
 import boto3
 import json
 import mimetypes
+import optparse
+import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.config import Config
+
+# Time kept in reserve at the end of an invocation to checkpoint the progress
+# into a continuation token
+TIME_RESERVE_SECONDS = 30
+
+# Objects larger than a single copy_object accepts are copied part by part
+MAX_COPY_OBJECT_SIZE = 5 * 1024 ** 3
+
+# Size of the parts of a multipart copy, raised for objects which would
+# otherwise need more parts than a multipart upload accepts
+COPY_PART_SIZE = 512 * 1024 ** 2
+MAX_PARTS = 10000
+
+# Number of parts copied in parallel
+DEFAULT_CONCURRENCY = 16
+
+# Number of keys listed, and re-keyed concurrently, between two cursors of a
+# bulk re-key
+REKEY_PAGE_SIZE = 100
+
+# S3 clients are re-used by warm invocations, their connection pools are
+# sized to the number of parts copied in parallel
+s3_clients = {}
+
+
+# ARNs of the keys given by id, ARN or alias, re-used by warm invocations
+key_arns = {}
+
+
+def get_key_arn(kms_key_id):
+    """ARN of a key given by its id, ARN or alias, as returned by HEAD."""
+    if kms_key_id not in key_arns:
+        key_arns[kms_key_id] = boto3.client('kms').describe_key(
+            KeyId=kms_key_id)['KeyMetadata']['Arn']
+    return key_arns[kms_key_id]
+
+
+def get_s3_client(concurrency):
+    if concurrency not in s3_clients:
+        s3_clients[concurrency] = boto3.client(
+            's3', config=Config(max_pool_connections=concurrency))
+    return s3_clients[concurrency]
+
+
+def reencrypt_object(s3_client, bucket_name, object_key, kms_key_id):
+    """Copy an object onto itself so this account owns it under the CMK."""
+    s3_client.copy_object(
+        Bucket=bucket_name,
+        Key=object_key,
+        CopySource={'Bucket': bucket_name, 'Key': object_key},
+        MetadataDirective='COPY',
+        ServerSideEncryption='aws:kms',
+        SSEKMSKeyId=kms_key_id)
+
+
+def copy_part(s3_client, bucket_name, object_key, upload_id, part_number, first, last, deadline):
+    """Copy a range of an object into a part, skipped past the deadline."""
+    if time.time() > deadline:
+        return None
+    response = s3_client.upload_part_copy(
+        Bucket=bucket_name,
+        Key=object_key,
+        CopySource={'Bucket': bucket_name, 'Key': object_key},
+        CopySourceRange=f'bytes={first}-{last}',
+        UploadId=upload_id,
+        PartNumber=part_number)
+    return response['CopyPartResult']['ETag']
+
+
+def list_parts(s3_client, bucket_name, object_key, upload_id):
+    parts = {}
+    paginator = s3_client.get_paginator('list_parts')
+    for page in paginator.paginate(Bucket=bucket_name, Key=object_key, UploadId=upload_id):
+        for part in page.get('Parts', []):
+            parts[part['PartNumber']] = part['ETag']
+    return parts
+
+
+def reencrypt_object_multipart(s3_client, executor, bucket_name, object_key, head, kms_key_id, upload_id, deadline):
+    """ Copy a large object onto itself part by part
+
+    The parts are copied in parallel by the executor. Parts already copied by
+    a previous invocation are listed from the upload. Returns the upload id
+    when parts are left at the deadline, None once the upload is completed.
+    """
+    if upload_id is None:
+        # Unlike copy_object, a multipart upload does not copy the metadata
+        upload_id = s3_client.create_multipart_upload(
+            Bucket=bucket_name,
+            Key=object_key,
+            ContentType=head.get('ContentType', 'binary/octet-stream'),
+            Metadata=head.get('Metadata', {}),
+            ServerSideEncryption='aws:kms',
+            SSEKMSKeyId=kms_key_id)['UploadId']
+        parts = {}
+    else:
+        parts = list_parts(s3_client, bucket_name, object_key, upload_id)
+
+    try:
+        size = head['ContentLength']
+        part_size = max(COPY_PART_SIZE, -(-size // MAX_PARTS))
+        futures = {}
+        for index, first in enumerate(range(0, size, part_size)):
+            if index + 1 not in parts:
+                futures[index + 1] = executor.submit(
+                    copy_part, s3_client, bucket_name, object_key, upload_id,
+                    index + 1, first, min(first + part_size, size) - 1,
+                    deadline)
+
+        for part_number, future in futures.items():
+            etag = future.result()
+            if etag is not None:
+                parts[part_number] = etag
+
+        print(f'{object_key}: {len(parts)} of {-(-size // part_size)} parts copied')
+        if len(parts) < -(-size // part_size):
+            return upload_id
+
+        s3_client.complete_multipart_upload(
+            Bucket=bucket_name,
+            Key=object_key,
+            UploadId=upload_id,
+            MultipartUpload={'Parts': [
+                {'PartNumber': part_number, 'ETag': parts[part_number]}
+                for part_number in sorted(parts)
+            ]})
+        return None
+
+    except Exception:
+        s3_client.abort_multipart_upload(
+            Bucket=bucket_name, Key=object_key, UploadId=upload_id)
+        raise
+
+
+def update_artifact(s3_client, executor, bucket_name, object_key, kms_key_id, upload_id, deadline):
+    """Re-encrypt an artifact, returns the upload id of an unfinished copy."""
+    head = s3_client.head_object(Bucket=bucket_name, Key=object_key)
+    if upload_id is None and head['ContentLength'] <= MAX_COPY_OBJECT_SIZE:
+        reencrypt_object(s3_client, bucket_name, object_key, kms_key_id)
+        return None
+    return reencrypt_object_multipart(
+        s3_client, executor, bucket_name, object_key, head, kms_key_id,
+        upload_id, deadline)
+
+
+def is_encrypted_with(head, key_arn):
+    """Whether an object is encrypted with the key, HEAD returns its ARN."""
+    return head.get('ServerSideEncryption') == 'aws:kms' and \
+        head.get('SSEKMSKeyId') == key_arn
+
+
+def rekey_object(s3_client, executor, bucket_name, object_key, kms_key_id, key_arn, force):
+    """Re-encrypt an object unless it already uses the key, returns whether it was copied."""
+    head = s3_client.head_object(Bucket=bucket_name, Key=object_key)
+    if not force and is_encrypted_with(head, key_arn):
+        return False
+    if head['ContentLength'] <= MAX_COPY_OBJECT_SIZE:
+        reencrypt_object(s3_client, bucket_name, object_key, kms_key_id)
+    else:
+        reencrypt_object_multipart(
+            s3_client, executor, bucket_name, object_key, head, kms_key_id,
+            None, float('inf'))
+    return True
+
+
+def rekey_prefix(s3_client, bucket_name, prefix, kms_key_id, start_after, concurrency, force, deadline, save_cursor=None):
+    """ Re-encrypt every object under a prefix with the key
+
+    Objects are listed in key order a page at a time and each page is
+    re-keyed concurrently. The cursor, the last key of the last page
+    completed, is passed to save_cursor after each page and re-keying
+    resumes after it. No new page is started past the deadline. Returns the
+    stats and the cursor, None once the prefix is done.
+    """
+    stats = {'copied': 0, 'skipped': 0, 'failed': 0}
+    key_arn = get_key_arn(kms_key_id)
+    kwargs = {'Bucket': bucket_name, 'Prefix': prefix}
+    if start_after:
+        kwargs['StartAfter'] = start_after
+
+    paginator = s3_client.get_paginator('list_objects_v2')
+    pages = paginator.paginate(
+        **kwargs, PaginationConfig={'PageSize': REKEY_PAGE_SIZE})
+
+    # Objects and the parts of large objects are copied by separate pools
+    with ThreadPoolExecutor(max_workers=concurrency) as executor, \
+            ThreadPoolExecutor(max_workers=concurrency) as object_executor:
+        for page in pages:
+            keys = [content['Key'] for content in page.get('Contents', [])]
+            futures = {
+                key: object_executor.submit(
+                    rekey_object, s3_client, executor, bucket_name, key,
+                    kms_key_id, key_arn, force)
+                for key in keys
+            }
+
+            # A failed object does not abort its siblings, it is logged and
+            # left for a run from the start, which skips the objects already
+            # re-keyed
+            for key, future in futures.items():
+                try:
+                    stats['copied' if future.result() else 'skipped'] += 1
+                except Exception as e:
+                    print(f'{key} failed: {e}')
+                    stats['failed'] += 1
+
+            if keys:
+                start_after = keys[-1]
+                if save_cursor is not None:
+                    save_cursor(start_after)
+            print(f'start_after: {start_after} {json.dumps(stats)}')
+
+            if time.time() > deadline:
+                return stats, start_after
+
+    return stats, None
+
+
+def rekey_handler(event, context):
+    """ Bulk re-key of the artifact bucket, invoked outside of the pipeline
+
+    The event holds bucketName, kmsKeyId and optionally prefix, startAfter,
+    concurrency and force. The result holds the stats and startAfter, the
+    cursor to invoke the function with again until it is null.
+    """
+    print(json.dumps(event))
+
+    concurrency = int(event.get('concurrency', DEFAULT_CONCURRENCY))
+    deadline = time.time() + \
+        context.get_remaining_time_in_millis() / 1000 - TIME_RESERVE_SECONDS
+
+    stats, start_after = rekey_prefix(
+        get_s3_client(2 * concurrency),
+        event['bucketName'],
+        event.get('prefix', ''),
+        event['kmsKeyId'],
+        event.get('startAfter'),
+        concurrency,
+        event.get('force', False),
+        deadline)
+    return {**stats, 'startAfter': start_after}
 
 
 def lambda_handler(event, context):
     # pylint: disable=E1101
 
+    if 'CodePipeline.job' not in event:
+        return rekey_handler(event, context)
+
     cp_client = boto3.client('codepipeline')
     try:
         print(event)
@@ -33,27 +284,72 @@ def lambda_handler(event, context):
             job_data['actionConfiguration']['configuration']['UserParameters'])
         print(params)
 
-        inputs = job_data['inputArtifacts']
+        concurrency = int(params.get('concurrency', DEFAULT_CONCURRENCY))
+
+        # Stop copying parts when the remaining time is needed to checkpoint
+        # the progress
+        deadline = time.time() + \
+            context.get_remaining_time_in_millis() / 1000 - TIME_RESERVE_SECONDS
 
-        for input in inputs:
-            print(input['location'])
+        # The continuation token holds the multipart upload of each artifact
+        # still to copy
+        if 'continuationToken' in job_data:
+            token = json.loads(job_data['continuationToken'])
+            uploads = token['uploads']
+            failures = token['failures']
+        else:
+            uploads = {}
+            for input in job_data['inputArtifacts']:
+                print(input['location'])
+                uploads[input['location']['s3Location']['objectKey']] = None
+            failures = []
 
-            bucket_name = input['location']['s3Location']['bucketName']
-            object_key = input['location']['s3Location']['objectKey']
+        # Artifacts live in the artifact bucket of the pipeline
+        bucket_name = params['bucketName']
 
-            s3 = boto3.resource('s3')
-            obj = s3.Object(bucket_name, object_key)
-            body = obj.get()['Body'].read()
+        # Re-write the objects server side using this account to change the
+        # owner; the bytes never leave S3. Artifacts are copied concurrently,
+        # the parts of large artifacts are copied by a single pool.
+        s3_client = get_s3_client(concurrency + len(uploads))
+        with ThreadPoolExecutor(max_workers=concurrency) as executor, \
+                ThreadPoolExecutor(max_workers=max(len(uploads), 1)) as artifact_executor:
+            futures = {
+                object_key: artifact_executor.submit(
+                    update_artifact, s3_client, executor, bucket_name,
+                    object_key, params['kmsKeyId'], upload_id, deadline)
+                for object_key, upload_id in uploads.items()
+            }
 
-            # Re-write the object using this account to change the owner
-            bucket = boto3.resource('s3').Bucket(bucket_name)
-            bucket.put_object(
-                Body=(body),
-                Key=object_key,
-                ServerSideEncryption='aws:kms',
-                SSEKMSKeyId=params['kmsKeyId'])
+            # A failed artifact does not abort its siblings
+            next_uploads = {}
+            for object_key, future in futures.items():
+                try:
+                    upload_id = future.result()
+                    if upload_id is not None:
+                        next_uploads[object_key] = upload_id
+                except Exception as e:
+                    print(f'{object_key} failed: {e}')
+                    failures.append(f'{object_key}: {e}')
 
-        cp_client.put_job_success_result(jobId=job_id)
+        if next_uploads:
+            print(f'next_uploads: {json.dumps(next_uploads)}')
+            cp_client.put_job_success_result(
+                jobId=job_id,
+                continuationToken=json.dumps({
+                    'uploads': next_uploads,
+                    'failures': failures
+                })
+            )
+        elif failures:
+            cp_client.put_job_failure_result(
+                jobId=job_id, failureDetails={
+                    # The failure message is limited to 5000 characters
+                    'message': '\n'.join(failures)[:5000],
+                    'type': 'JobFailed'
+                }
+            )
+        else:
+            cp_client.put_job_success_result(jobId=job_id)
 
     except Exception as e:
         # If any other exceptions which we didn't expect are raised
@@ -66,3 +362,45 @@ def lambda_handler(event, context):
                 'type': 'JobFailed'
             }
         )
+
+
+if __name__ == '__main__':
+    # Bulk re-key from a workstation, e.g. after rotating the key:
+    #   python index.py --bucket-name <bucket> --kms-key-id <key> \
+    #       --cursor-file rekey.cursor
+    # An interrupted run resumes from the cursor saved in the cursor file.
+    parser = optparse.OptionParser()
+    parser.add_option('--bucket-name', action='store', dest='bucket_name')
+    parser.add_option('--kms-key-id', action='store', dest='kms_key_id')
+    parser.add_option('--prefix', action='store', dest='prefix', default='')
+    parser.add_option('--start-after', action='store', dest='start_after')
+    parser.add_option('--cursor-file', action='store', dest='cursor_file')
+    parser.add_option('--concurrency', action='store', type='int',
+                      dest='concurrency', default=DEFAULT_CONCURRENCY)
+    parser.add_option('--force', action='store_true', dest='force',
+                      default=False)
+
+    options, _remainder = parser.parse_args()
+
+    start_after = options.start_after
+    save_cursor = None
+    if options.cursor_file:
+        if start_after is None and os.path.exists(options.cursor_file):
+            with open(options.cursor_file) as cursor_file:
+                start_after = cursor_file.read().strip() or None
+
+        def save_cursor(cursor):
+            with open(options.cursor_file, 'w') as cursor_file:
+                cursor_file.write(cursor)
+
+    stats, _start_after = rekey_prefix(
+        get_s3_client(2 * options.concurrency),
+        options.bucket_name,
+        options.prefix,
+        options.kms_key_id,
+        start_after,
+        options.concurrency,
+        options.force,
+        float('inf'),
+        save_cursor)
+    print(json.dumps(stats))
@@ -0,0 +1,231 @@
+######################################################################################################################
+#  Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.                                           #
+#                                                                                                                    #
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance    #
+#  with the License. A copy of the License is located at                                                             #
+#                                                                                                                    #
+#      http://www.apache.org/licenses/LICENSE-2.0                                                                    #
+#                                                                                                                    #
+#  or in the 'license' file accompanying this file. This file is distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES #
+#  OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions    #
+#  and limitations under the License.                                                                                #
+######################################################################################################################
+
+import json
+import mimetypes
+import re
+import struct
+import zipfile
+import zlib
+
+from urllib.parse import urlparse
+from botocore.exceptions import ClientError
+
+# A repository snapshot is published under the repository prefix as a single
+# zip archive and a json index of its members.
+SNAPSHOT_ARCHIVE_FILE_NAME = '.snapshot/archive.zip'
+SNAPSHOT_INDEX_FILE_NAME = '.snapshot/index.json'
+
+# Size of the fixed part of a zip local file header
+LOCAL_FILE_HEADER_SIZE = 30
+
+# Templates declaring this resource type refer to nested templates, see
+# get_referenced_paths
+NESTED_STACK_TYPE = 'AWS::CloudFormation::Stack'
+TEMPLATE_PATH_PATTERN = re.compile(r'[\w./-]+\.(?:ya?ml|json|template)')
+TEMPLATE_EXTENSION_PATTERN = re.compile(r'\.(?:ya?ml|json|template)$')
+
+
+def get_member_index(fileobj):
+    """ Lists the files of a zip archive with the offset of their data
+
+    The data of a file can then be fetched with a single range request.
+    """
+    members = {}
+    with zipfile.ZipFile(fileobj) as zip:
+        for info in zip.infolist():
+            if info.is_dir():
+                continue
+
+            # The data follows the local file header, whose extra field may
+            # differ from the one of the central directory
+            fileobj.seek(info.header_offset)
+            header = fileobj.read(LOCAL_FILE_HEADER_SIZE)
+            name_length, extra_length = struct.unpack('<HH', header[26:30])
+            members[info.filename] = {
+                'offset': info.header_offset + LOCAL_FILE_HEADER_SIZE + name_length + extra_length,
+                'compressedSize': info.compress_size,
+                'size': info.file_size,
+                'compressType': info.compress_type,
+                'crc': info.CRC
+            }
+    return members
+
+
+def save_index(s3_client, bucket_name, prefix, members, kms_key_id, details):
+    """ Saves the index of the snapshot archive of a prefix
+
+    The details (the source commit for instance) are stored along with the
+    members.
+    """
+    index = dict(details)
+    index.update({
+        'archive': f'{prefix}/{SNAPSHOT_ARCHIVE_FILE_NAME}',
+        'kmsKeyId': kms_key_id,
+        'members': members
+    })
+    s3_client.put_object(
+        Bucket=bucket_name,
+        Key=f'{prefix}/{SNAPSHOT_INDEX_FILE_NAME}',
+        Body=json.dumps(index),
+        ContentType='application/json',
+        ServerSideEncryption='aws:kms',
+        SSEKMSKeyId=kms_key_id)
+    return index
+
+
+def load_index(s3_client, bucket_name, prefix):
+    """ Loads the index of the snapshot archive of a prefix, None if the
+    prefix has no snapshot
+    """
+    try:
+        response = s3_client.get_object(
+            Bucket=bucket_name,
+            Key=f'{prefix}/{SNAPSHOT_INDEX_FILE_NAME}')
+    except s3_client.exceptions.NoSuchKey:
+        return None
+    return json.loads(response['Body'].read())
+
+
+def read_member(s3_client, bucket_name, index, path):
+    """ Reads a file of the snapshot archive with a range request
+    """
+    member = index['members'][path]
+    if member['compressedSize'] == 0:
+        return b''
+
+    first = member['offset']
+    last = first + member['compressedSize'] - 1
+    data = s3_client.get_object(
+        Bucket=bucket_name,
+        Key=index['archive'],
+        Range=f'bytes={first}-{last}')['Body'].read()
+
+    if member['compressType'] == zipfile.ZIP_DEFLATED:
+        data = zlib.decompress(data, -zlib.MAX_WBITS)
+    elif member['compressType'] != zipfile.ZIP_STORED:
+        raise Exception(f'Unsupported compression for {path}')
+
+    if zlib.crc32(data) != member['crc']:
+        raise Exception(f'Bad CRC for {path}')
+    return data
+
+
+def get_referenced_paths(body, paths):
+    """ Paths of a repository referred to by a template with nested stacks
+
+    Nested templates are referred to by URL, whose repository prefix is
+    usually a parameter (!Sub with ${pRepo} for instance), so every file
+    name mentioned in the template is matched against the paths of the
+    repository by its trailing segments. Extra matches are harmless.
+    """
+    if isinstance(body, bytes):
+        body = body.decode('utf-8', errors='replace')
+    if NESTED_STACK_TYPE not in body:
+        return set()
+
+    referenced = set()
+    for match in TEMPLATE_PATH_PATTERN.findall(body):
+        segments = match.split('/')
+        for i in range(len(segments)):
+            candidate = '/'.join(segments[i:])
+            if candidate in paths:
+                referenced.add(candidate)
+    return referenced
+
+
+def read_templates(s3_client, bucket_name, index, paths):
+    """ Reads templates of a snapshot archive and the nested templates they
+    refer to, recursively. Returns their bodies by path.
+    """
+    bodies = {}
+    pending = list(paths)
+    while pending:
+        member = pending.pop()
+        bodies[member] = read_member(s3_client, bucket_name, index, member)
+        for referenced in get_referenced_paths(bodies[member], index['members']):
+            if referenced not in bodies and referenced not in pending:
+                pending.append(referenced)
+    return bodies
+
+
+def put_members(s3_client, bucket_name, index, prefix, bodies):
+    """Puts members of a snapshot archive to their own object, in order."""
+    for member, body in bodies:
+        args = {
+            'Bucket': bucket_name,
+            'Key': f'{prefix}/{member}',
+            'Body': body,
+            'ServerSideEncryption': 'aws:kms',
+            'SSEKMSKeyId': index['kmsKeyId']
+        }
+        content_type = mimetypes.guess_type(member)[0]
+        if content_type is not None:
+            args['ContentType'] = content_type
+        s3_client.put_object(**args)
+
+        print(f'Extracted {prefix}/{member} from {index["archive"]}')
+
+
+def materialize_nested_templates(s3_client, bucket_name, prefix, index):
+    """ Extracts the nested templates of a snapshot archive when it is
+    published
+
+    Native CloudFormation actions read their template from the pipeline
+    artifact, but the nested stacks of the template fetch theirs from the
+    bucket. Returns the number of templates extracted.
+    """
+    templates = [
+        path for path in index['members']
+        if TEMPLATE_EXTENSION_PATTERN.search(path)
+    ]
+    bodies = read_templates(s3_client, bucket_name, index, templates)
+    nested = set()
+    for path, body in bodies.items():
+        nested |= get_referenced_paths(body, index['members']) - {path}
+
+    put_members(s3_client, bucket_name, index, prefix, [
+        (path, bodies[path]) for path in sorted(nested)
+    ])
+    return len(nested)
+
+
+def materialize_template(s3_client, template_url):
+    """ Makes sure the object of a template URL exists
+
+    Templates published in a snapshot archive are extracted to their own
+    object the first time CloudFormation needs them, along with the nested
+    templates they refer to, recursively. The nested templates are put
+    first so that an existing template object implies its nested templates
+    exist. Returns True if the template was extracted.
+    """
+    url = urlparse(template_url)
+    bucket_name = url.netloc.split('.s3')[0]
+    key = url.path.lstrip('/')
+
+    try:
+        s3_client.head_object(Bucket=bucket_name, Key=key)
+        return False
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ['404', 'NoSuchKey', 'NotFound']:
+            raise
+
+    prefix, _, path = key.partition('/')
+    index = load_index(s3_client, bucket_name, prefix)
+    if index is None or path not in index['members']:
+        return False
+
+    bodies = read_templates(s3_client, bucket_name, index, [path])
+    put_members(s3_client, bucket_name, index, prefix, sorted(
+        bodies.items(), key=lambda item: item[0] == path))
+    return True
@@ -98,7 +98,8 @@ export class CorePipelineStack extends cfw.PipelineStackBase {
           'repositoryNames': [
             this.sources[cfw.CENTRAL_CORE].repo.repositoryName,
           ],
-          'branchName': this.props.pipelineName
+          'branchName': this.props.pipelineName,
+          'syncMode': 'incremental'
         },
         inputs: [
           this.sources[cfw.CENTRAL_CORE].output,
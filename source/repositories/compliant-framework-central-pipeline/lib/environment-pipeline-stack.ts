@@ -53,7 +53,7 @@ export class EnvironmentPipelineStack extends cfw.PipelineStackBase {
     this.sources[repoName] = {
       repo: codecommit.Repository.fromRepositoryName(this, resourceId,
         `compliant-framework-${repoName}`),
-      output: new codepipeline.Artifact()
+      output: new codepipeline.Artifact(repoName)
     }
 
     repoName = cfw.MANAGEMENT_SERVICES_CORE
@@ -61,7 +61,7 @@ export class EnvironmentPipelineStack extends cfw.PipelineStackBase {
     this.sources[repoName] = {
       repo: codecommit.Repository.fromRepositoryName(this, resourceId,
         `compliant-framework-${repoName}`),
-      output: new codepipeline.Artifact()
+      output: new codepipeline.Artifact(repoName)
     }
 
     repoName = cfw.SECURITY_BASELINE
@@ -69,7 +69,7 @@ export class EnvironmentPipelineStack extends cfw.PipelineStackBase {
     this.sources[repoName] = {
       repo: codecommit.Repository.fromRepositoryName(this, resourceId,
         `compliant-framework-${repoName}`),
-      output: new codepipeline.Artifact()
+      output: new codepipeline.Artifact(repoName)
     }
 
     //
@@ -81,7 +81,7 @@ export class EnvironmentPipelineStack extends cfw.PipelineStackBase {
       this.sources[repoName] = {
         repo: codecommit.Repository.fromRepositoryName(this, resourceId,
           `compliant-framework-${repoName}`),
-        output: new codepipeline.Artifact()
+        output: new codepipeline.Artifact(repoName)
       }
     }
   }
@@ -178,23 +178,30 @@ export class EnvironmentPipelineStack extends cfw.PipelineStackBase {
 
   /**
    * Expands the zip files into S3
+   *
+   * A single action expands up to 5 sources, the maximum number of input
+   * artifacts of a Lambda invoke action.
    */
   private getExpandS3SourcesActions(): codepipeline.IAction[] {
     var actions: codepipeline.IAction[] = []
-    for (var source in this.sources) {
+    var names = Object.keys(this.sources)
+    for (var i = 0; i < names.length; i += 5) {
+      var repositories: { [artifactName: string]: string } = {}
+      var inputs: codepipeline.Artifact[] = []
+      for (var source of names.slice(i, i + 5)) {
+        repositories[source] = this.sources[source].repo.repositoryName
+        inputs.push(this.sources[source].output)
+      }
       actions.push(
         new codepipeline_actions.LambdaInvokeAction({
-          actionName: source,
+          actionName: (i == 0) ? 'ExpandS3Sources' : `ExpandS3Sources-${i / 5 + 1}`,
           lambda: this.lambdas['expand_s3_sources'],
           userParameters: {
             'bucketName': this.s3Bucket.bucketName,
             'kmsKeyId': this.s3BucketCmkAlias.keyId,
-            'repositoryName': this.sources[source].repo.repositoryName,
-            'branchName': this.props.pipelineName
+            'repositories': repositories
           },
-          inputs: [
-            this.sources[source].output,
-          ],
+          inputs: inputs,
           runOrder: 1,
         }),
       )
@@ -239,7 +246,8 @@ export class EnvironmentPipelineStack extends cfw.PipelineStackBase {
             'repositoryNames': [
               this.sources[source].repo.repositoryName,
             ],
-            'branchName': this.props.pipelineName
+            'branchName': this.props.pipelineName,
+            'syncMode': 'incremental'
           },
           inputs: [
             this.sources[source].output,
@@ -947,6 +955,22 @@ export class EnvironmentPipelineStack extends cfw.PipelineStackBase {
     this.s3Bucket.grantReadWrite(
       this.lambdas[cfw.UPDATE_ARTIFACT_ACL]
     )
+    // The bulk re-key resolves the alias of the key to compare it with the
+    // key of the objects
+    this.lambdas[cfw.UPDATE_ARTIFACT_ACL].addToRolePolicy(
+      new iam.PolicyStatement({
+        effect: iam.Effect.ALLOW,
+        actions: [
+          'kms:DescribeKey'
+        ],
+        resources: [
+          this.s3BucketCmkAlias.aliasTargetKey.keyArn
+        ]
+      })
+    );
+    this.s3Bucket.grantReadWrite(
+      this.lambdas[cfw.STACK_SET_ACTION]
+    )
 
     for (var source in this.sources) {
       this.sources[source].repo.grantRead(
@@ -983,7 +1007,9 @@ export class EnvironmentPipelineStack extends cfw.PipelineStackBase {
           'cloudformation:DescribeStackSetOperation',
           'cloudformation:TagResource',
           'cloudformation:UpdateStackSet',
-          'ssm:getParameter'
+          'ssm:getParameter',
+          'ssm:GetParameters',
+          'ssm:GetParametersByPath'
         ],
         resources: [
           '*'
@@ -1011,7 +1037,9 @@ export class EnvironmentPipelineStack extends cfw.PipelineStackBase {
       new iam.PolicyStatement({
         effect: iam.Effect.ALLOW,
         actions: [
-          'ssm:GetParameter'
+          'ssm:GetParameter',
+          'ssm:GetParameters',
+          'ssm:GetParametersByPath'
         ],
         resources: [
           '*'
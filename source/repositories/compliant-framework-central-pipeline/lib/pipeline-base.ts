@@ -16,6 +16,8 @@ import * as cdk from '@aws-cdk/core';
 import * as codecommit from '@aws-cdk/aws-codecommit';
 import * as codepipeline from '@aws-cdk/aws-codepipeline';
 import * as codepipeline_actions from '@aws-cdk/aws-codepipeline-actions';
+import * as events from '@aws-cdk/aws-events';
+import * as events_targets from '@aws-cdk/aws-events-targets';
 import * as iam from '@aws-cdk/aws-iam';
 import * as kms from '@aws-cdk/aws-kms';
 import * as lambda from '@aws-cdk/aws-lambda';
@@ -37,6 +39,14 @@ export const SECURITY_HUB_INVITE_MEMBERS = 'security_hub_invite_members';
 export const UPDATE_ARTIFACT_ACL = 'update_artifact_acl';
 export const GET_SSM_PARAMETERS = 'get_ssm_parameters';
 export const STACK_SET_ACTION = 'stack_set_action';
+export const COMPLETE_STACK_JOBS = 'complete_stack_jobs';
+export const EXPAND_S3_SOURCES = 'expand_s3_sources';
+
+// Memory of the lambda functions needing more than the default. Members are
+// buffered part by part while expand_s3_sources streams them into S3.
+const LAMBDA_MEMORY_SIZES: { [name: string]: number } = {
+  [EXPAND_S3_SOURCES]: 1024,
+};
 
 // Regions
 export const US_GOV_WEST_1 = 'us-gov-west-1'
@@ -132,6 +142,7 @@ export abstract class PipelineStackBase extends cdk.Stack {
     this.createCmks();
     this.createArtifactBuckets();
     this.createLambdas();
+    this.createCompletionRule();
   }
 
   /**
@@ -206,8 +217,16 @@ export abstract class PipelineStackBase extends cdk.Stack {
    * lambda functions. A reference to the function will be stored into
    * the lambdas list and can be accessed using the name of the lambda
    * package.
+   *
+   * The python modules of the lambda_shared folder are published as a
+   * layer used by all the lambda functions.
    */
   private createLambdas(): void {
+    const sharedLayer = new lambda.LayerVersion(this, 'rLambdaSharedLayer', {
+      code: new lambda.AssetCode('lambda_shared'),
+      compatibleRuntimes: [lambda.Runtime.PYTHON_3_8],
+    });
+
     fs.readdirSync('lambda/').forEach(file => {
       this.lambdas[file] =
         new lambda.Function(this, file.replace(/-/gi, ''), {
@@ -216,10 +235,73 @@ export abstract class PipelineStackBase extends cdk.Stack {
           handler: 'index.lambda_handler',
           timeout: cdk.Duration.seconds(300),
           runtime: lambda.Runtime.PYTHON_3_8,
+          memorySize: LAMBDA_MEMORY_SIZES[file],
+          layers: [sharedLayer],
         });
     });
   }
 
+  /**
+   * Completes the create_update_stack and stack_set_action jobs using the
+   * 'completionMode': 'event' user parameter when their CloudFormation
+   * operation ends, instead of polling for it.
+   *
+   * Every pipeline of the account receives the events, each function only
+   * completes the jobs of its own pipeline.
+   */
+  private createCompletionRule(): void {
+    new events.Rule(this, 'rCompleteStackJobsRule', {
+      eventPattern: {
+        source: ['aws.cloudformation'],
+        detailType: [
+          'CloudFormation Stack Status Change',
+          'CloudFormation StackSet Operation Status Change'
+        ],
+        detail: {
+          'status-details': {
+            'status': [
+              'CREATE_COMPLETE',
+              'UPDATE_COMPLETE',
+              'UPDATE_ROLLBACK_COMPLETE',
+              'ROLLBACK_COMPLETE',
+              'CREATE_FAILED',
+              'ROLLBACK_FAILED',
+              'DELETE_FAILED',
+              'UPDATE_ROLLBACK_FAILED',
+              'SUCCEEDED',
+              'FAILED',
+              'STOPPED'
+            ]
+          }
+        }
+      },
+      targets: [
+        new events_targets.LambdaFunction(this.lambdas[COMPLETE_STACK_JOBS])
+      ]
+    });
+
+    this.lambdas[COMPLETE_STACK_JOBS].addEnvironment(
+      'PIPELINE_NAME', `compliant-framework-${this.props.pipelineName}`);
+
+    this.lambdas[COMPLETE_STACK_JOBS].addToRolePolicy(
+      new iam.PolicyStatement({
+        effect: iam.Effect.ALLOW,
+        actions: [
+          'cloudformation:DescribeStacks',
+          'codepipeline:GetJobDetails',
+          'codepipeline:PutJobFailureResult',
+          'codepipeline:PutJobSuccessResult',
+          'ssm:DeleteParameters',
+          'ssm:GetParametersByPath',
+          'ssm:PutParameter'
+        ],
+        resources: [
+          '*'
+        ]
+      })
+    );
+  }
+
   protected getStageOutput(
     variable: string,
     region: string,